@@ -8,7 +8,38 @@
 # 	4a) For each subproject, copy everything except "include" into $DEST/libs
 # 	4b) For each subproject, copy the contents of the "includes" folder into $DEST/boost
 #
-# 	Usage: %0 source dest
+# 	Usage: %0 [-j jobs] source dest
+#
+# 	All of the copies are planned first and then run on a pool of "jobs"
+# 	threads (default 1, i.e. serially).
+#
+# 	With "--link hardlink" or "--link reflink" the files are hardlinked or
+# 	cloned (FICLONE, btrfs/xfs) from the source instead of copied, falling
+# 	back to a copy for each file that can't be linked. A hardlinked tree
+# 	shares its files with the source checkout, so files in it must be
+# 	replaced rather than modified in place.
+#
+# 	"--manifest file" writes the path, size, mode, mtime, hash and library of
+# 	every file in the tree to a JSON file, for use by the later stages.
+#
+# 	"--incremental mtime" or "--incremental hash" updates an existing dest
+# 	in place instead of renaming it and starting over, copying only what
+# 	changed and deleting what is gone.
+#
+# 	"--ignore-file file" leaves out the names matching the patterns in file
+# 	(one per line), in addition to the dot files and CI configs.
+#
+# 	Headers provided by more than one library are all reported up front, and
+# 	"--conflicts error" fails when their contents differ. The libraries are
+# 	processed in sorted order, so the header that is kept is always the same.
+#
+# 	PlanDistro() plans the tree without copying anything, and WriteTar()
+# 	writes the planned tree straight into a tar stream.
+#
+# 	The same can be done from python with:
+#
+# 		import MakeBoostDistro
+# 		manifest = MakeBoostDistro.main(source, dest, jobs=8)
 
 from __future__ import print_function
 
@@ -17,34 +48,395 @@ import shutil
 import stat
 import six
 import datetime
+import collections
+import concurrent.futures
+import optparse
+import hashlib
+import json
+import fnmatch
+import filecmp
+import tarfile
+import re
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # not available on Windows
+
+
+class DistroError(Exception):
+    """The release tree can't be made, see PlanDistro and main."""
+
+
+class IgnorePatterns(object):
+    """
+    Shell style patterns of the names left out of the release, compiled once
+    into a single regular expression. An instance can be used as the ignore
+    argument of shutil.copytree, or to match a single name.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        flags = re.IGNORECASE if os.path.normcase("A") == "a" else 0
+        self.regex = re.compile(
+            "|".join(fnmatch.translate(p) for p in self.patterns) or "(?!)", flags
+        )
+
+    def match(self, name):
+        return self.regex.match(name) is not None
+
+    def __call__(self, src, names):
+        return set(n for n in names if self.regex.match(n))
+
+    def extend(self, patterns):
+        return IgnorePatterns(self.patterns + list(patterns))
+
+
+def ReadIgnoreFile(path):
+    """
+    Read ignore patterns from a file, one per line. Blank lines and lines
+    starting with "#" are skipped.
+    """
+    patterns = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                patterns.append(line)
+    return patterns
+
+
+IgnoreFiles = IgnorePatterns(
+    [
+        "[.]*",
+        "[.]gitattributes",
+        "[.]gitignore",
+        "[.]gitmodules",
+        "[.]travis[.]yml",
+        "appveyor[.]yml",
+        "circle[.]yml",
+    ]
+)
+
 
-IgnoreFiles = shutil.ignore_patterns(
-    "[.]*",
-    "[.]gitattributes",
-    "[.]gitignore",
-    "[.]gitmodules",
-    "[.]travis[.]yml",
-    "appveyor[.]yml",
-    "circle[.]yml",
+# From linux/fs.h
+FICLONE = 0x40049409
+
+
+def HardlinkFile(s, d):
+    try:
+        os.link(s, d)
+    except OSError:
+        # Cross device, unsupported filesystem, link count limit...
+        shutil.copy2(s, d)
+
+
+def ReflinkFile(s, d):
+    try:
+        with open(s, "rb") as fs, open(d, "wb") as fd:
+            fcntl.ioctl(fd.fileno(), FICLONE, fs.fileno())
+    except (IOError, OSError, AttributeError):
+        shutil.copy2(s, d)
+    else:
+        shutil.copystat(s, d)
+
+
+CopyFunctions = {
+    "copy": shutil.copy2,
+    "hardlink": HardlinkFile,
+    "reflink": ReflinkFile,
+}
+
+
+def FileDigest(path, hash_name):
+    h = hashlib.new(hash_name)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+ManifestFields = ["path", "size", "mode", "mtime", "hash", "library"]
+ManifestEntry = collections.namedtuple(
+    "ManifestEntry", ManifestFields + ["source"], defaults=[None]
 )
 
 
-def IgnoreFile(src, name):
-    return len(IgnoreFiles(src, [name])) > 0
+class Manifest(object):
+    """
+    What was put in the release tree: the destination root and one entry per
+    file, with its path relative to the root ("/" separated), size, mode,
+    mtime, content hash and the library it came from (None for files that
+    don't belong to a library), plus the source file when known.
+
+    The hash is md5 by default, as that is what rclone and S3 compare.
+    """
+
+    def __init__(self, root, entries, hash_name=None):
+        self.root = root
+        self.entries = entries
+        self.hash_name = hash_name
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def paths(self):
+        return [e.path for e in self.entries]
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(
+                {
+                    "root": os.path.basename(os.path.normpath(self.root)),
+                    "hash": self.hash_name,
+                    "fields": ManifestFields,
+                    "files": [list(e[: len(ManifestFields)]) for e in self.entries],
+                },
+                f,
+                separators=(",", ":"),
+            )
+
+
+def ReadManifest(path, root=None):
+    """
+    Read a Manifest written by Manifest.write. The root defaults to the tree
+    it was written for, next to the manifest file.
+    """
+    with open(path, "r") as f:
+        data = json.load(f)
+    if root is None:
+        root = os.path.join(os.path.dirname(path), data["root"])
+    fields = data["fields"]
+    entries = [ManifestEntry(**dict(zip(fields, e))) for e in data["files"]]
+    return Manifest(root, entries, data["hash"])
+
+
+class CopyPlan(object):
+    """
+    The list of work needed to assemble the release tree. The tree is walked
+    once, recording every directory to create and every file to copy in the
+    order the serial copier used to process them, and the copies are then run
+    on a bounded thread pool.
+    """
+
+    def __init__(self, ignore=IgnoreFiles):
+        # The names left out of the release.
+        self.ignore = ignore
+        # The checkout and the tree planned from it.
+        self.source = None
+        self.root = None
+        # (dst, src) in creation order, src is set when the directory
+        # gets the stat of its source when it is created.
+        self.dirs = []
+        self.known_dirs = set()
+        # dst -> (src, library), a later copy to the same dst replaces the
+        # earlier one.
+        self.files = collections.OrderedDict()
+        # (src, dst) to apply once all the files have been copied.
+        self.dir_stats = []
+        # The library the files being planned come from.
+        self.origin = None
+        # dst -> (size, mode, mtime, hash) once copied with a hash_name.
+        self.placed = {}
+        # dst -> [(library, src)] of the files merged into the headers.
+        self.merged = collections.OrderedDict()
+
+    def makedir(self, dst, src=None):
+        if dst not in self.known_dirs:
+            self.known_dirs.add(dst)
+            self.dirs.append((dst, src))
+
+    def copy(self, s, d, report=False):
+        if report:
+            if d in self.files:
+                print("## Overwriting file %s with %s" % (d, s))
+            self.merged.setdefault(d, []).append((self.origin, s))
+        self.files[d] = (s, self.origin)
+
+    def conflicts(self):
+        """
+        The merged header files that more than one library provides, as
+        dst -> [(library, src)] in copy order, the last one being kept.
+        """
+        return collections.OrderedDict(
+            (d, sources) for d, sources in self.merged.items() if len(sources) > 1
+        )
+
+    def copytree(self, src, dst, ignore=None):
+        names = os.listdir(src)
+        if ignore is not None:
+            ignored_names = ignore(src, names)
+        else:
+            ignored_names = set()
+        self.makedir(dst)
+        for name in names:
+            if name in ignored_names:
+                continue
+            s = os.path.join(src, name)
+            d = os.path.join(dst, name)
+            if os.path.isdir(s):
+                self.copytree(s, d, ignore)
+            else:
+                self.copy(s, d)
+        self.dir_stats.append((src, dst))
+
+    def unchanged(self, s, d, compare, previous, hash_name):
+        """
+        Whether the existing d is already a copy of s, comparing size, mode
+        and mtime or the content hash. The hash of d is taken from the
+        previous manifest when there is one.
+        """
+        try:
+            st_s = os.stat(s)
+            st_d = os.stat(d)
+        except OSError:
+            return False
+        if not stat.S_ISREG(st_d.st_mode) or st_s.st_size != st_d.st_size:
+            return False
+        if stat.S_IMODE(st_s.st_mode) != stat.S_IMODE(st_d.st_mode):
+            return False
+        if compare == "mtime":
+            return st_s.st_mtime_ns == st_d.st_mtime_ns
+        entry = previous.get(d)
+        if entry is not None and entry.hash and entry.size == st_d.st_size:
+            digest = entry.hash
+        else:
+            digest = FileDigest(d, hash_name)
+        return FileDigest(s, hash_name) == digest
+
+    def prune(self, root):
+        """
+        Remove everything under root that is not part of the plan, and
+        return the number of files removed.
+        """
+        removed = 0
+        # The planned directories and all the ones above the planned paths,
+        # which an overlay like x/y/f doesn't make on its own.
+        parents = set()
+        for path in list(self.files) + list(self.known_dirs):
+            parent = os.path.dirname(path)
+            while parent not in parents and len(parent) > len(root):
+                parents.add(parent)
+                parent = os.path.dirname(parent)
+        keep = self.known_dirs | parents
+        for dirpath, dirnames, filenames in os.walk(root, topdown=False):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if path not in self.files:
+                    os.remove(path)
+                    removed += 1
+            for name in dirnames:
+                path = os.path.join(dirpath, name)
+                if path not in keep:
+                    if os.path.islink(path):
+                        os.remove(path)
+                    else:
+                        # Already emptied, as the walk is bottom up.
+                        os.rmdir(path)
+        return removed
+
+    def execute(self, jobs=1, link="copy", hash_name=None, compare=None, previous=None):
+        """
+        Create the directories and copy the files. With compare ("mtime" or
+        "hash") the files that are already up to date in the destination
+        are left alone. previous is the path -> ManifestEntry of the tree
+        being updated, used to avoid hashing it again.
+        """
+        copy_function = CopyFunctions[link]
+        previous = previous or {}
+        for dst, src in self.dirs:
+            if not os.path.exists(dst):
+                os.makedirs(dst)
+                if src is not None:
+                    shutil.copystat(src, dst)
+
+        skipped = []
+
+        def place(item):
+            d, (s, library) = item
+            if compare and self.unchanged(s, d, compare, previous, hash_name or "md5"):
+                skipped.append(d)
+                entry = previous.get(d)
+                if hash_name and entry is not None and entry.hash:
+                    self.placed[d] = (entry.size, entry.mode, entry.mtime, entry.hash)
+                    return
+            else:
+                if os.path.lexists(d):
+                    # Replace rather than rewrite, d may be a hardlink.
+                    os.remove(d)
+                copy_function(s, d)
+            if hash_name:
+                # Hash the copy while it is still in the page cache.
+                st = os.stat(d)
+                self.placed[d] = (
+                    st.st_size,
+                    stat.S_IMODE(st.st_mode),
+                    int(st.st_mtime),
+                    FileDigest(d, hash_name),
+                )
+
+        items = list(self.files.items())
+        if jobs > 1:
+            with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+                # Consume the results so that copy errors are raised here.
+                for _ in pool.map(place, items):
+                    pass
+        else:
+            for item in items:
+                place(item)
+
+        for src, dst in self.dir_stats:
+            shutil.copystat(src, dst)
+        return len(items) - len(skipped)
+
+    def entries(self):
+        """
+        All the directories and files of the planned tree, parents first,
+        as (path, src, isdir) sorted by path. The path is relative to the
+        root of the tree, and src is the directory whose stat a directory
+        gets, None for the ones created without one.
+        """
+        dir_sources = dict((dst, src) for dst, src in self.dirs if src is not None)
+        dir_sources.update((dst, src) for src, dst in self.dir_stats)
+        dirs = set(self.known_dirs)
+        for d in list(self.known_dirs) + list(self.files.keys()):
+            p = os.path.dirname(d)
+            while p and p != self.root and p not in dirs:
+                dirs.add(p)
+                p = os.path.dirname(p)
+        entries = []
+        for d in dirs:
+            path = os.path.relpath(d, self.root).replace(os.sep, "/")
+            entries.append((path, dir_sources.get(d), True))
+        for d, (s, library) in self.files.items():
+            path = os.path.relpath(d, self.root).replace(os.sep, "/")
+            entries.append((path, s, False))
+        entries.sort()
+        return entries
+
+    def manifest(self, root, hash_name=None):
+        entries = []
+        for d, (s, library) in self.files.items():
+            path = os.path.relpath(d, root).replace(os.sep, "/")
+            size, mode, mtime, digest = self.placed.get(d, (None,) * 4)
+            entries.append(
+                ManifestEntry(path, size, mode, mtime, digest, library, source=s)
+            )
+        return Manifest(root, entries, hash_name)
 
 
 ## from <http://stackoverflow.com/questions/1868714/how-do-i-copy-an-entire-directory-of-files-into-an-existing-directory-using-pyth>
-def MergeTree(src, dst, symlinks=False):
-    if not os.path.exists(dst):
-        os.makedirs(dst)
-        shutil.copystat(src, dst)
-    lst = os.listdir(src)
-    excl = IgnoreFiles(src, lst)
-    lst = [x for x in lst if x not in excl]
+def MergeTree(plan, src, dst, symlinks=False):
+    plan.makedir(dst, src)
+    lst = [x for x in os.listdir(src) if not plan.ignore.match(x)]
     for item in lst:
         s = os.path.join(src, item)
         d = os.path.join(dst, item)
         if symlinks and os.path.islink(s):
+            # Links are not planned, they are cheap enough to make in place.
             if os.path.lexists(d):
                 os.remove(d)
             os.symlink(os.readlink(s), d)
@@ -55,35 +447,31 @@ def MergeTree(src, dst, symlinks=False):
             except:
                 pass  # lchmod not available
         elif os.path.isdir(s):
-            MergeTree(s, d, symlinks)
+            MergeTree(plan, s, d, symlinks)
         else:
-            if os.path.exists(d):
-                print("## Overwriting file %s with %s" % (d, s))
-            shutil.copy2(s, d)
+            plan.copy(s, d, report=True)
 
 
-def CopyFile(s, d, f):
-    if os.path.isfile(os.path.join(s, f)) and not IgnoreFile(s, f):
-        shutil.copy2(os.path.join(s, f), os.path.join(d, f))
+def CopyFile(plan, s, d, f, report=False):
+    if os.path.isfile(os.path.join(s, f)) and not plan.ignore.match(f):
+        plan.copy(os.path.join(s, f), os.path.join(d, f), report)
 
 
-def CopyDir(s, d, dd):
-    if os.path.isdir(os.path.join(s, dd)) and not IgnoreFile(s, dd):
-        shutil.copytree(
-            os.path.join(s, dd), os.path.join(d, dd), symlinks=False, ignore=IgnoreFiles
-        )
+def CopyDir(plan, s, d, dd):
+    if os.path.isdir(os.path.join(s, dd)) and not plan.ignore.match(dd):
+        plan.copytree(os.path.join(s, dd), os.path.join(d, dd), ignore=plan.ignore)
 
 
-def MergeIf(s, d, dd):
+def MergeIf(plan, s, d, dd):
     # 	if dd == 'detail':
     # 		print "MergeIf %s -> %s" % (os.path.join(s, dd), os.path.join(d, dd))
     if os.path.exists(os.path.join(s, dd)):
-        MergeTree(os.path.join(s, dd), os.path.join(d, dd), symlinks=False)
+        MergeTree(plan, os.path.join(s, dd), os.path.join(d, dd), symlinks=False)
 
 
-def CopyInclude(src, dst):
+def CopyInclude(plan, src, dst):
     for item in os.listdir(src):
-        if IgnoreFile(src, item):
+        if plan.ignore.match(item):
             continue
         if item == "pending":
             continue
@@ -92,133 +480,357 @@ def CopyInclude(src, dst):
         s = os.path.join(src, item)
         d = os.path.join(dst, item)
         if os.path.isdir(s):
-            MergeTree(s, d, symlinks=False)
+            MergeTree(plan, s, d, symlinks=False)
         else:
-            if os.path.exists(d):
-                print("## Overwriting file %s with %s" % (d, s))
-            CopyFile(src, dst, item)
+            CopyFile(plan, src, dst, item, report=True)
 
 
-def CopySubProject(src, dst, headers, p):
+def CopySubProject(plan, src, dst, headers, p):
     # 	First, everything except the "include" directory
     Source = os.path.join(src, p)
     Dest = os.path.join(dst, p)
     # 	print "CopySubProject %p" % p
-    os.makedirs(Dest)
+    plan.makedir(Dest)
     for item in os.listdir(Source):
         if os.path.isfile(os.path.join(Source, item)):
-            CopyFile(Source, Dest, item)
+            CopyFile(plan, Source, Dest, item)
         elif item != "include":
-            CopyDir(Source, Dest, item)
+            CopyDir(plan, Source, Dest, item)
 
     # shutil.copytree(Source, Dest, symlinks=False, ignore=shutil.ignore_patterns('\.*', "include"))
 
     # Now the includes
     Source = os.path.join(src, "%s/include/boost" % p)
     if os.path.exists(Source):
-        CopyInclude(Source, headers)
+        CopyInclude(plan, Source, headers)
         # 		MergeTree(Source, Dest, symlinks=False, ignore=shutil.ignore_patterns('\.*', 'detail', 'pending'))
-        MergeIf(Source, headers, "detail")
-        MergeIf(Source, headers, "pending")
+        MergeIf(plan, Source, headers, "detail")
+        MergeIf(plan, Source, headers, "pending")
 
 
-def CopyNestedProject(src, dst, headers, p):
+def CopyNestedProject(plan, src, dst, headers, p):
     # 	First, everything except the "include" directory
     Source = os.path.join(src, p[1])
     Dest = os.path.join(dst, p[1])
-    os.makedirs(Dest)
+    plan.makedir(Dest)
     for item in os.listdir(Source):
         if os.path.isfile(os.path.join(Source, item)):
-            CopyFile(Source, Dest, item)
+            CopyFile(plan, Source, Dest, item)
         elif item != "include":
-            CopyDir(Source, Dest, item)
+            CopyDir(plan, Source, Dest, item)
     # 	shutil.copytree(Source, Dest, symlinks=False, ignore=shutil.ignore_patterns('\.*', "include"))
 
     Source = os.path.join(src, "%s/include/boost" % (p[1]))
     #  	Dest = os.path.join(headers, p)
     # 	print "Installing headers from %s to %s" % (Source, headers)
-    CopyInclude(Source, headers)
+    CopyInclude(plan, Source, headers)
     # # 	MergeTree(Source, Dest, symlinks=False, ignore=shutil.ignore_patterns('\.*', 'detail', 'pending'))
     # 	MergeIf(Source, headers, 'detail')
     # 	MergeIf(Source, headers, 'pending')
 
 
+def ReportConflicts(plan, root):
+    """
+    Print the headers that more than one library provides, and return
+    whether all of the copies of each of them are identical.
+    """
+    identical = True
+    conflicts = plan.conflicts()
+    if conflicts:
+        print("## %d headers are provided by more than one library:" % len(conflicts))
+    for d, sources in conflicts.items():
+        same = all(filecmp.cmp(sources[0][1], s, shallow=False) for _, s in sources)
+        identical = identical and same
+        print(
+            "##   %s%s: %s"
+            % (
+                os.path.relpath(d, root).replace(os.sep, "/"),
+                "" if same else " (different)",
+                ", ".join(library or "-" for library, _ in sources),
+            )
+        )
+    return identical
+
+
+def NormalizeTarInfo(tarinfo, mtime):
+    """
+    Make a tar entry reproducible: clamp its mtime to mtime, make it owned
+    by root and give it 0755 or 0644 permissions.
+    """
+    tarinfo.mtime = min(tarinfo.mtime, mtime)
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = ""
+    if tarinfo.isdir() or tarinfo.mode & 0o111:
+        tarinfo.mode = 0o755
+    else:
+        tarinfo.mode = 0o644
+    return tarinfo
+
+
+def WriteTar(plan, fileobj, mtime=None):
+    """
+    Write the planned tree as an uncompressed tar stream to fileobj, reading
+    the files straight from their sources instead of from a copy of the tree.
+    The directories created without a source get the stat of the checkout.
+    Links are followed, as they are when the tree is copied. With an mtime,
+    the entries are normalized with NormalizeTarInfo so that the same tree
+    always gives the same stream.
+    """
+    if mtime is None:
+        normalize = None
+    else:
+        normalize = lambda tarinfo: NormalizeTarInfo(tarinfo, mtime)
+    name = os.path.basename(os.path.normpath(plan.root))
+    # Dereference links to directories too, as copying the tree does, so
+    # that they are directories in the stream as they are in a copy.
+    with tarfile.open(
+        fileobj=fileobj, mode="w|", format=tarfile.GNU_FORMAT, dereference=True
+    ) as tar:
+        tar.add(plan.source, name, recursive=False, filter=normalize)
+        for path, src, isdir in plan.entries():
+            arcname = name + "/" + path
+            if isdir:
+                tar.add(src or plan.source, arcname, recursive=False, filter=normalize)
+            else:
+                # Follow links to files, as copying them does.
+                with open(src, "rb") as f:
+                    tarinfo = tar.gettarinfo(arcname=arcname, fileobj=f)
+                    if normalize:
+                        normalize(tarinfo)
+                    tar.addfile(tarinfo, f)
+
+
 BoostHeaders = "boost"
 BoostLibs = "libs"
 
 BoostSpecialFolders = ["doc", "more", "status", "tools"]
 
-SourceRoot = sys.argv[1]
-DestRoot = sys.argv[2]
-
-print("Source = %s" % SourceRoot)
-print("Dest   = %s" % DestRoot)
 
-if not os.path.exists(SourceRoot):
-    print("## Error: %s does not exist" % SourceRoot)
-    exit(1)
-
-if os.path.exists(DestRoot):
-    print(
-        "The destination directory already exists. Renaming it, so that a new one can be generated.\n"
+def PlanDistro(SourceRoot, DestRoot, overlays=(), ignore=(), conflicts="warn"):
+    """
+    Plan the release tree DestRoot from the boost checkout SourceRoot,
+    without copying anything, and return the CopyPlan. See main for the
+    arguments.
+    """
+    plan = CopyPlan(IgnoreFiles.extend(ignore))
+    plan.source = SourceRoot
+    plan.root = DestRoot
+
+    DestHeaders = os.path.join(DestRoot, BoostHeaders)
+    DestLibs = os.path.join(DestRoot, BoostLibs)
+    plan.makedir(DestHeaders)
+    plan.makedir(DestLibs)
+
+    ## Step 1
+    for f in os.listdir(SourceRoot):
+        if f != "CMakeLists.txt":
+            CopyFile(plan, SourceRoot, DestRoot, f)
+
+    ## Step 2
+    for d in BoostSpecialFolders:
+        CopyDir(plan, SourceRoot, DestRoot, d)
+
+    ## Step 3
+    SourceLibs = os.path.join(SourceRoot, BoostLibs)
+    for f in os.listdir(SourceLibs):
+        CopyFile(plan, SourceLibs, DestLibs, f)
+
+    ## Step 4
+    BoostSubProjects = set()
+    for f in os.listdir(SourceLibs):
+        if os.path.isdir(os.path.join(SourceLibs, f)):
+            if os.path.isfile(os.path.join(SourceLibs, f, "meta", "libraries.json")):
+                BoostSubProjects.add(f)
+            elif os.path.isdir(os.path.join(SourceLibs, f, "include")):
+                BoostSubProjects.add(f)
+            elif f == "headers":
+                BoostSubProjects.add(f)
+            elif os.path.isfile(os.path.join(SourceLibs, f, "sublibs")):
+                for s in os.listdir(os.path.join(SourceLibs, f)):
+                    if os.path.isdir(os.path.join(SourceLibs, f, s)):
+                        if os.path.isfile(
+                            os.path.join(SourceLibs, f, s, "meta", "libraries.json")
+                        ):
+                            BoostSubProjects.add((f, s))
+                        elif os.path.isdir(os.path.join(SourceLibs, f, s, "include")):
+                            BoostSubProjects.add((f, s))
+
+    # Sorted, so that the library whose header is kept when several provide
+    # the same one doesn't depend on the set iteration order.
+    BoostSubProjects = sorted(
+        BoostSubProjects, key=lambda p: (p,) if isinstance(p, six.string_types) else p
     )
-    timestamp1 = datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
-    os.rename(DestRoot, DestRoot + "_bck_" + timestamp1)
-
-if not os.path.exists(DestRoot):
-    print("Creating destination directory %s" % DestRoot)
-    os.makedirs(DestRoot)
-
-DestHeaders = os.path.join(DestRoot, BoostHeaders)
-DestLibs = os.path.join(DestRoot, BoostLibs)
-os.makedirs(DestHeaders)
-os.makedirs(DestLibs)
-
-## Step 1
-for f in os.listdir(SourceRoot):
-    if f != "CMakeLists.txt":
-        CopyFile(SourceRoot, DestRoot, f)
-
-## Step 2
-for d in BoostSpecialFolders:
-    CopyDir(SourceRoot, DestRoot, d)
-
-## Step 3
-SourceLibs = os.path.join(SourceRoot, BoostLibs)
-for f in os.listdir(SourceLibs):
-    CopyFile(SourceLibs, DestLibs, f)
-
-## Step 4
-BoostSubProjects = set()
-for f in os.listdir(SourceLibs):
-    if os.path.isdir(os.path.join(SourceLibs, f)):
-        if os.path.isfile(os.path.join(SourceLibs, f, "meta", "libraries.json")):
-            BoostSubProjects.add(f)
-        elif os.path.isdir(os.path.join(SourceLibs, f, "include")):
-            BoostSubProjects.add(f)
-        elif f == "headers":
-            BoostSubProjects.add(f)
-        elif os.path.isfile(os.path.join(SourceLibs, f, "sublibs")):
-            for s in os.listdir(os.path.join(SourceLibs, f)):
-                if os.path.isdir(os.path.join(SourceLibs, f, s)):
-                    if os.path.isfile(
-                        os.path.join(SourceLibs, f, s, "meta", "libraries.json")
-                    ):
-                        BoostSubProjects.add((f, s))
-                    elif os.path.isdir(os.path.join(SourceLibs, f, s, "include")):
-                        BoostSubProjects.add((f, s))
-
-for p in BoostSubProjects:
-    if isinstance(p, six.string_types):
-        CopySubProject(SourceLibs, DestLibs, DestHeaders, p)
-    else:
-        NestedSource = os.path.join(SourceRoot, "libs", p[0])
-        NestedDest = os.path.join(DestRoot, "libs", p[0])
-        NestedHeaders = os.path.join(DestRoot, "boost")
-        if not os.path.exists(NestedDest):
-            os.makedirs(NestedDest)
-        if not os.path.exists(NestedHeaders):
-            os.makedirs(NestedHeaders)
-        for f in os.listdir(NestedSource):
-            CopyFile(NestedSource, NestedDest, f)
-        CopyNestedProject(NestedSource, NestedDest, NestedHeaders, p)
+    for p in BoostSubProjects:
+        if isinstance(p, six.string_types):
+            plan.origin = p
+            CopySubProject(plan, SourceLibs, DestLibs, DestHeaders, p)
+        else:
+            NestedSource = os.path.join(SourceRoot, "libs", p[0])
+            NestedDest = os.path.join(DestRoot, "libs", p[0])
+            NestedHeaders = os.path.join(DestRoot, "boost")
+            plan.makedir(NestedDest)
+            plan.makedir(NestedHeaders)
+            plan.origin = p[0]
+            for f in os.listdir(NestedSource):
+                CopyFile(plan, NestedSource, NestedDest, f)
+            plan.origin = "/".join(p)
+            CopyNestedProject(plan, NestedSource, NestedDest, NestedHeaders, p)
+
+    ## Step 5
+    plan.origin = None
+    for src, path in overlays:
+        d = os.path.join(DestRoot, path)
+        if os.path.isdir(src):
+            plan.copytree(src, d)
+        else:
+            plan.makedir(os.path.dirname(d))
+            plan.copy(src, d)
+
+    ## Step 6
+    if not ReportConflicts(plan, DestRoot) and conflicts == "error":
+        raise DistroError("conflicting headers, not copying anything")
+
+    return plan
+
+
+def main(
+    SourceRoot,
+    DestRoot,
+    jobs=1,
+    link="copy",
+    manifest=None,
+    overlays=(),
+    incremental=None,
+    ignore=(),
+    conflicts="warn",
+):
+    """
+    Make the release tree DestRoot from the boost checkout SourceRoot, and
+    return the Manifest of the files put in it.
+
+    overlays is a list of (source, path) of files or directories put in the
+    tree at path after everything else, replacing what is there. When
+    manifest is given the files are hashed as they are copied and the
+    Manifest is also written to that file.
+
+    With incremental ("mtime" or "hash") an existing DestRoot is updated in
+    place: only the files that differ from the source, by size, mode and
+    mtime or by content hash, are copied, and the files that are no longer
+    part of the release are removed. When the manifest file of the previous
+    run exists, the hashes of the existing tree are taken from it.
+
+    ignore is a list of patterns of names to leave out of the release, in
+    addition to IgnoreFiles.
+
+    All the headers provided by more than one library are reported before
+    anything is copied. With conflicts="error" it stops there if any of
+    them differ, raising DistroError, as it does when SourceRoot is missing.
+    """
+    print("Source = %s" % SourceRoot)
+    print("Dest   = %s" % DestRoot)
+
+    if not os.path.exists(SourceRoot):
+        raise DistroError("%s does not exist" % SourceRoot)
+
+    # Plan first, so that nothing is moved or made when it fails.
+    plan = PlanDistro(SourceRoot, DestRoot, overlays, ignore, conflicts)
+
+    if os.path.exists(DestRoot) and incremental:
+        print("Updating the existing destination directory (%s)" % incremental)
+    elif os.path.exists(DestRoot):
+        print(
+            "The destination directory already exists. Renaming it, so that a new one can be generated.\n"
+        )
+        timestamp1 = datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
+        os.rename(DestRoot, DestRoot + "_bck_" + timestamp1)
+
+    if not os.path.exists(DestRoot):
+        print("Creating destination directory %s" % DestRoot)
+        os.makedirs(DestRoot)
+
+    ## Step 7
+    hash_name = "md5" if manifest else None
+    previous = {}
+    if incremental:
+        removed = plan.prune(DestRoot)
+        if manifest and os.path.isfile(manifest):
+            old = ReadManifest(manifest, DestRoot)
+            if old.hash_name == (hash_name or "md5"):
+                previous = dict((os.path.join(DestRoot, e.path), e) for e in old)
+    copied = plan.execute(jobs, link, hash_name, incremental, previous)
+    if incremental:
+        print(
+            "Copied %d files, %d unchanged, %d removed"
+            % (copied, len(plan.files) - copied, removed)
+        )
+    result = plan.manifest(DestRoot, hash_name)
+    if manifest:
+        result.write(manifest)
+    return result
+
+
+if __name__ == "__main__":
+    opt = optparse.OptionParser(usage="%prog [options] source dest")
+    opt.add_option(
+        "-j",
+        "--jobs",
+        help="number of threads copying files (default 1)",
+        type="int",
+        default=1,
+        dest="jobs",
+    )
+    opt.add_option(
+        "--link",
+        help="how files are placed in the destination: copy (default), hardlink or reflink",
+        type="choice",
+        choices=sorted(CopyFunctions.keys()),
+        default="copy",
+        dest="link",
+    )
+    opt.add_option(
+        "--manifest",
+        help="write the manifest of the release tree to this file",
+        default=None,
+        dest="manifest",
+    )
+    opt.add_option(
+        "--incremental",
+        help="update an existing destination, comparing files by mtime or hash",
+        type="choice",
+        choices=["mtime", "hash"],
+        default=None,
+        dest="incremental",
+    )
+    opt.add_option(
+        "--ignore-file",
+        help="file with more patterns of names to leave out, one per line",
+        default=None,
+        dest="ignore_file",
+    )
+    opt.add_option(
+        "--conflicts",
+        help="when different headers have the same name: warn (default) or error",
+        type="choice",
+        choices=["warn", "error"],
+        default="warn",
+        dest="conflicts",
+    )
+    (options, args) = opt.parse_args()
+    if len(args) != 2:
+        opt.print_help()
+        sys.exit(1)
+
+    try:
+        main(
+            args[0],
+            args[1],
+            jobs=options.jobs,
+            link=options.link,
+            manifest=options.manifest,
+            incremental=options.incremental,
+            ignore=ReadIgnoreFile(options.ignore_file) if options.ignore_file else (),
+            conflicts=options.conflicts,
+        )
+    except DistroError as e:
+        print("## Error: %s" % e)
+        sys.exit(1)
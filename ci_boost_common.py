@@ -19,6 +19,7 @@ import subprocess
 import codecs
 import shutil
 import threading
+import hashlib
 import distutils.dir_util
 
 # For urllib
@@ -43,9 +44,32 @@ class utils:
 
     @staticmethod
     def call(*command, **kargs):
+        return utils.call_usage(*command, **kargs)[0]
+
+    @staticmethod
+    def call_usage(*command, **kargs):
+        """
+        Like call, but returns the result with the wall time and the CPU
+        time, user and system, of the command. The CPU time is None where
+        it can't be measured.
+        """
         utils.log("%s> '%s'" % (os.getcwd(), "' '".join(command)))
         t = time.time()
-        result = subprocess.call(command, **kargs)
+        process = subprocess.Popen(command, **kargs)
+        cpu = None
+        if hasattr(os, "wait4"):
+            try:
+                _pid, status, usage = os.wait4(process.pid, 0)
+                cpu = usage.ru_utime + usage.ru_stime
+                if os.WIFSIGNALED(status):
+                    process.returncode = -os.WTERMSIG(status)
+                else:
+                    process.returncode = os.WEXITSTATUS(status)
+            except:
+                process.kill()
+                process.wait()
+                raise
+        result = process.wait()
         t = time.time() - t
         if result != 0:
             print("Failed: '%s' ERROR = %s" % ("' '".join(command), result))
@@ -53,7 +77,7 @@ class utils:
         utils.log(
             "%s> '%s' execution time %s seconds" % (os.getcwd(), "' '".join(command), t)
         )
-        return result
+        return (result, t, cpu)
 
     @staticmethod
     def print_call_stats():
@@ -190,6 +214,22 @@ class utils:
         f.write("\n".join(text))
         f.close()
 
+    @staticmethod
+    def file_hashes(filename, hash_names=["sha256"], block_size=1024 * 1024):
+        """
+        Hashes the file with each of the named hashlib algorithms, reading
+        it in blocks. Returns a dict of the hex digests by name.
+        """
+        hashers = [hashlib.new(hash_name) for hash_name in hash_names]
+        with open(filename, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                for hasher in hashers:
+                    hasher.update(block)
+        return dict(
+            (hash_name, hasher.hexdigest())
+            for hash_name, hasher in zip(hash_names, hashers)
+        )
+
     @staticmethod
     def mem_info():
         if sys.platform == "darwin":
@@ -206,7 +246,9 @@ class parallel_call(threading.Thread):
         self.start()
 
     def run(self):
-        self.result = utils.call(*self.command, **self.command_kargs)
+        (self.result, self.wall_time, self.cpu_time) = utils.call_usage(
+            *self.command, **self.command_kargs
+        )
 
     def join(self):
         super(parallel_call, self).join()
@@ -214,6 +256,130 @@ class parallel_call(threading.Thread):
             raise SystemCallError(self.command, self.result)
 
 
+class stream_tee(object):
+    """
+    A write only file object that writes everything to all of the given
+    streams.
+    """
+
+    def __init__(self, streams):
+        self.streams = streams
+
+    def write(self, data):
+        for stream in self.streams:
+            stream.write(data)
+        return len(data)
+
+    def flush(self):
+        for stream in self.streams:
+            stream.flush()
+
+
+class parallel_pipe(threading.Thread):
+    """
+    Runs commands in parallel, like parallel_call, all reading the one
+    stream written by writer(stream) from this process. The outputs are
+    (output_file, command) pairs, the standard output of each command is
+    saved to its output_file. The saved outputs are hashed with each of
+    hash_names as they are written, see hashes.
+    """
+
+    def __init__(self, writer, outputs, hash_names=[], **kargs):
+        super(parallel_pipe, self).__init__()
+        self.writer = writer
+        self.outputs = outputs
+        self.hash_names = hash_names
+        self.hashes = {}
+        self.command_kargs = kargs
+        self.results = []
+        self.start_error = None
+        self.error = None
+        self.start()
+
+    def run(self):
+        processes = []
+        savers = []
+        try:
+            for output_file, command in self.outputs:
+                utils.log(
+                    "%s> '%s' > '%s'" % (os.getcwd(), "' '".join(command), output_file)
+                )
+                process = subprocess.Popen(
+                    command,
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    **self.command_kargs
+                )
+                processes.append(process)
+                savers.append(
+                    threading.Thread(
+                        target=self.save, args=(process.stdout, output_file)
+                    )
+                )
+                savers[-1].start()
+        except Exception as e:
+            # A command could not be started, the ones that were are stopped.
+            self.start_error = e
+            for process in processes:
+                process.kill()
+                process.stdin.close()
+            for saver in savers:
+                saver.join()
+            for process in processes:
+                process.wait()
+            return
+        t = time.time()
+        try:
+            self.writer(stream_tee([process.stdin for process in processes]))
+        except Exception as e:
+            self.error = e
+        finally:
+            for process in processes:
+                try:
+                    process.stdin.close()
+                except (IOError, OSError):
+                    pass
+        for saver in savers:
+            saver.join()
+        for process, (output_file, command) in zip(processes, self.outputs):
+            result = process.wait()
+            self.results.append((command, result))
+            if result != 0:
+                print("Failed: '%s' ERROR = %s" % ("' '".join(command), result))
+            utils.call_stats.append((time.time() - t, os.getcwd(), command, result))
+        utils.log(
+            "%s> '%s' execution time %s seconds"
+            % (
+                os.getcwd(),
+                "' | '".join(" ".join(command) for _, command in self.outputs),
+                time.time() - t,
+            )
+        )
+
+    def save(self, stdout, output_file):
+        hashers = [hashlib.new(hash_name) for hash_name in self.hash_names]
+        with open(output_file, "wb") as output:
+            for block in iter(lambda: stdout.read(1024 * 1024), b""):
+                output.write(block)
+                for hasher in hashers:
+                    hasher.update(block)
+        stdout.close()
+        self.hashes[output_file] = dict(
+            (hash_name, hasher.hexdigest())
+            for hash_name, hasher in zip(self.hash_names, hashers)
+        )
+
+    def join(self):
+        super(parallel_pipe, self).join()
+        if self.start_error is not None:
+            raise self.start_error
+        for command, result in self.results:
+            if result != 0:
+                raise SystemCallError(command, result)
+        if self.error is not None:
+            raise self.error
+
+
 class script_common(object):
     """
     Main script to run Boost C++ Libraries continuous integration.
@@ -14,8 +14,10 @@ import time
 import shutil
 import site
 import hashlib
+import concurrent.futures
 import subprocess
 import os
+import stat
 import glob
 from jinja2 import Environment, BaseLoader
 import json
@@ -23,7 +25,19 @@ import pprint
 from collections import defaultdict
 import re
 
-from ci_boost_common import main, utils, script_common, parallel_call
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+from ci_boost_common import (
+    main,
+    utils,
+    script_common,
+    parallel_call,
+    parallel_pipe,
+    SystemCallError,
+)
 
 # Check python version
 if sys.version_info[0] == 2:
@@ -286,6 +300,41 @@ class script(script_common):
 
     archive_tag = "-snapshot"
 
+    # Where the snapshot archives are published, by branch.
+    archives_url = "https://archives.boost.io"
+
+    # Commands printing the versions of the tools that the archives are made
+    # with, included in the tree digest. Only the version of each is
+    # included, see tool_version.
+    tool_version_commands = [
+        ["tar", "--version"],
+        ["pigz", "--version"],
+        ["lbzip2", "--version"],
+        ["zstd", "--version"],
+        ["xz", "--version"],
+        ["zip", "-v"],
+        ["7z"],
+        ["doxygen", "--version"],
+        ["xsltproc", "--version"],
+        ["node", "--version"],
+    ]
+
+    # Names left out of the release tree, and so of all the archives, in
+    # addition to the ones MakeBoostDistro always leaves out. These are the
+    # scripts themselves, which are often fetched alone, without an ignore
+    # file next to them. Others are added with --distro-ignore-file.
+    distro_ignore = ["ci_boost_common.py", "ci_boost_release.py"]
+
+    # The compressed tar archives that can be made, by extension, with the
+    # command that compresses the tar stream for each of them. Which are
+    # made is set with --tar-formats.
+    tar_compressors = {
+        ".tar.gz": ["pigz"],
+        ".tar.bz2": ["lbzip2"],
+        ".tar.zst": ["zstd", "-q", "-T0", "-15"],
+        ".tar.xz": ["xz", "-T0", "-6"],
+    }
+
     def __init__(self, ci_klass, **kargs):
         os.environ["PATH"] += os.pathsep + os.path.join(site.getuserbase(), "bin")
         utils.log("PATH = %s" % (os.environ["PATH"]))
@@ -315,6 +364,89 @@ class script(script_common):
         )
         self.releases_dir = None
 
+        opt.add_option(
+            "--distro-incremental",
+            help="update an existing release tree, comparing files by 'mtime' or 'hash'",
+        )
+        self.distro_incremental = os.getenv("DISTRO_INCREMENTAL", None)
+
+        opt.add_option(
+            "--distro-ignore-file",
+            help="file with more patterns of names to leave out of the release,"
+            " one per line",
+        )
+        self.distro_ignore_file = os.getenv("DISTRO_IGNORE_FILE", None)
+
+        opt.add_option(
+            "--package-mode",
+            help="'tree' to package a copied release tree, or 'stream' to pack the"
+            " archives straight from the checkout (default 'tree')",
+        )
+        self.package_mode = os.getenv("PACKAGE_MODE", "tree")
+        self.distro_plan = None
+
+        opt.add_option(
+            "--archive-hashes",
+            help="comma separated hashlib algorithms to list in the archive"
+            " info files, in addition to sha256 (i.e. 'sha512,blake2b')",
+        )
+        self.archive_hashes = os.getenv("ARCHIVE_HASHES", "")
+
+        opt.add_option(
+            "--tar-formats",
+            help="comma separated tar archives to make for LF builds"
+            " (default '.tar.gz,.tar.bz2', also '.tar.zst' and '.tar.xz')",
+        )
+        self.tar_formats = os.getenv("TAR_FORMATS", ".tar.gz,.tar.bz2")
+
+        opt.add_option(
+            "--deterministic",
+            help="make reproducible archives: sorted entries, mtimes clamped to"
+            " the commit date, normalized ownership and permissions and fixed"
+            " compressor settings",
+            action="store_true",
+        )
+        self.deterministic = os.getenv("DETERMINISTIC", "") not in ["", "0", "false"]
+
+        opt.add_option(
+            "--force",
+            help="build and upload the snapshot even when the published one was"
+            " made from the same tree",
+            action="store_true",
+        )
+        self.force = os.getenv("FORCE", "") not in ["", "0", "false"]
+
+        opt.add_option(
+            "--upload-jobs",
+            help="number of archive uploads to run at the same time (default 8)",
+            type="int",
+        )
+        try:
+            self.upload_jobs = int(os.getenv("UPLOAD_JOBS"))
+        except:
+            self.upload_jobs = 8
+
+        opt.add_option(
+            "--upload-retries",
+            help="number of times to retry a failed upload (default 2)",
+            type="int",
+        )
+        try:
+            self.upload_retries = int(os.getenv("UPLOAD_RETRIES"))
+        except:
+            self.upload_retries = 2
+        self.release_unchanged = False
+
+        opt.add_option(
+            "--package-jobs",
+            help="CPU budget shared by the CRLF archivers (default: the number of CPUs)",
+            type="int",
+        )
+        try:
+            self.package_jobs = int(os.getenv("PACKAGE_JOBS"))
+        except:
+            self.package_jobs = None
+
         return kargs
 
     def start(self):
@@ -417,6 +549,16 @@ class script(script_common):
 
     def command_build(self):
         super(script, self).command_build()
+        # Nothing is built when the published snapshot was made from the
+        # same tree. See tree_digest. The digest is taken before the build
+        # changes anything, and with the branch known, as it is when the
+        # archives are uploaded.
+        self.resolve_branch()
+        self.tree_digest()
+        self.release_unchanged = self.published_release_unchanged()
+        if self.release_unchanged:
+            return
+
         # Build a packaged release. This involves building a fresh set
         # of docs and selectively packging parts of the tree. We try and
         # avoid creating extra files in the base tree to avoid including
@@ -590,23 +732,7 @@ class script(script_common):
         ## Determine the boost branch for which the antora script should
         ## generate the documentation
         os.chdir(self.root_dir)
-        if self.branch is None:
-            self.branch = "develop"
-            output = subprocess.check_output(
-                ["git", "branch", "--show-current"]
-            ).decode("utf-8")
-            lines = output.split("\n")
-            for line in lines:
-                if len(line) > 0:
-                    current_branch = line
-                    self.branch = current_branch
-                    break
-
-        ## Determine the branch of website-v2-docs to use
-        if self.branch == "master":
-            checkout_branch = "master"
-        else:
-            checkout_branch = "develop"
+        self.resolve_branch()
 
         # Set the environment variable BOOST_SRC_DIR to the root directory
         # so that the following scripts can find the boost source code
@@ -614,17 +740,7 @@ class script(script_common):
         os.environ["BOOST_SRC_DIR"] = self.root_dir
 
         # Call antora project main script
-        os.chdir(self.build_dir)
-        antora_dir = os.path.join(self.build_dir, "antora")
-        if not os.path.exists(antora_dir):
-            utils.check_call(
-                "git",
-                "clone",
-                "--depth=1",
-                "--branch=%s" % checkout_branch,
-                "https://github.com/boostorg/website-v2-docs.git",
-                "antora",
-            )
+        antora_dir = self.antora_checkout()
         os.chdir(antora_dir)
         if self.parse_semver(self.branch) is not None:
             libdoc_branch = self.boost_version
@@ -664,149 +780,245 @@ class script(script_common):
         elif not os.path.isabs(self.releases_dir):
             self.releases_dir = os.path.join(self.root_dir, self.releases_dir)
             utils.makedirs(self.releases_dir)
-        if os.path.isfile("MakeBoostDistro.py"):
-            import MakeBoostDistro
+        MakeBoostDistro = self.import_distro()
 
-            os.chdir(self.releases_dir)
-            MakeBoostDistro.main(self.root_dir, self.boost_release_name)
-        else:
-            os.chdir(os.path.join(self.build_dir))
-            utils.check_call(
-                "wget",
-                "https://raw.githubusercontent.com/boostorg/release-tools/master/MakeBoostDistro.py",
-                "-O",
-                "MakeBoostDistro.py",
+        distro_ignore = list(self.distro_ignore)
+        if self.distro_ignore_file:
+            distro_ignore.extend(
+                MakeBoostDistro.ReadIgnoreFile(self.distro_ignore_file)
             )
-            utils.check_call("chmod", "+x", "MakeBoostDistro.py")
-            os.chdir(os.path.dirname(self.root_dir))
-            utils.check_call(
-                pythonbinary,
-                os.path.join(self.build_dir, "MakeBoostDistro.py"),
+
+        # The release is patched with the html generated in-place and with
+        # the antora docs, as overlays of the release tree.
+        distro_overlays = [
+            (os.path.join(self.build_dir, sourcefilename), sourcefilename)
+            for sourcefilename in ["index.html", "libs/libraries.htm"]
+        ]
+        distro_overlays.append(
+            (os.path.join(self.build_dir, "antora/build/lib/doc"), "doc/antora")
+        )
+
+        # The manifest lists every file of the release tree with its size,
+        # mode, mtime, md5 and library. It is kept next to the tree so that
+        # it isn't packaged. See distro_manifest_wanted. Otherwise an old one
+        # is removed, it would be out of date.
+        os.chdir(self.releases_dir)
+        self.distro_manifest_file = os.path.join(
+            self.releases_dir, "%s.manifest.json" % (self.boost_release_name)
+        )
+        if not self.distro_manifest_wanted() and os.path.exists(
+            self.distro_manifest_file
+        ):
+            os.remove(self.distro_manifest_file)
+        if self.package_mode == "stream":
+            # Only plan the release tree. The tar archives are written from
+            # the plan, and the tree itself is hardlinked from the checkout
+            # when something needs it. See make_release_tree.
+            self.distro_plan = MakeBoostDistro.PlanDistro(
                 self.root_dir,
                 self.boost_release_name,
+                overlays=distro_overlays,
+                ignore=distro_ignore,
             )
-
-        # Patch release with the html generate in-place
-        for sourcefilename in ["index.html", "libs/libraries.htm"]:
-            shutil.copyfile(
-                os.path.join(self.build_dir, sourcefilename),
-                os.path.join(
-                    self.releases_dir, self.boost_release_name, sourcefilename
+            if os.path.exists(self.boost_release_name):
+                utils.rmtree(self.boost_release_name)
+        else:
+            self.distro_plan = None
+            MakeBoostDistro.main(
+                self.root_dir,
+                self.boost_release_name,
+                jobs=self.jobs,
+                manifest=(
+                    self.distro_manifest_file if self.distro_manifest_wanted() else None
                 ),
+                overlays=distro_overlays,
+                incremental=self.distro_incremental,
+                ignore=distro_ignore,
             )
 
-        # Patch release with antora docs
-        antora_lib_docs = os.path.join(self.build_dir, "antora/build/lib/doc")
-        release_lib_docs = os.path.join(
-            self.releases_dir, self.boost_release_name, "doc", "antora"
-        )
-        utils.makedirs(release_lib_docs)
-        shutil.copytree(
-            antora_lib_docs, release_lib_docs, symlinks=False, dirs_exist_ok=True
-        )
         packages = []
         archive_files = []
+        hash_names = ["sha256"] + [
+            hash_name
+            for hash_name in self.archive_hashes.split(",")
+            if hash_name and hash_name != "sha256"
+        ]
 
         # Create packages for LF style content.
         if self.eol == "LF":
             os.chdir(self.releases_dir)
             os.environ["GZIP"] = "-9"
             os.environ["BZIP2"] = "-9"
-            archive_files.append(
-                "%s%s.tar.gz" % (self.boost_release_name, self.archive_tag)
-            )
+            tar_compressors = [
+                (ext, self.tar_compressors[ext]) for ext in self.tar_extensions()
+            ]
+            if self.deterministic:
+                # Don't store the time in the gzip header. zstd and xz get a
+                # fixed number of threads, as 7z does, so that their output
+                # doesn't depend on the runner.
+                tar_compressors = [
+                    (
+                        ext,
+                        ["-T8" if arg == "-T0" else arg for arg in command]
+                        + (["-n"] if ext == ".tar.gz" else []),
+                    )
+                    for ext, command in tar_compressors
+                ]
+            # The tar stream is made once and fed to all the compressors.
             packages.append(
-                parallel_call(
-                    "tar",
-                    "--use-compress-program=pigz",
-                    "--exclude=ci_boost_common.py",
-                    "--exclude=ci_boost_release.py",
-                    "-cf",
-                    "%s%s.tar.gz" % (self.boost_release_name, self.archive_tag),
-                    self.boost_release_name,
+                parallel_pipe(
+                    self.write_tar,
+                    [
+                        (
+                            "%s%s%s" % (self.boost_release_name, self.archive_tag, ext),
+                            command,
+                        )
+                        for ext, command in tar_compressors
+                    ],
+                    hash_names=hash_names,
                 )
             )
-            archive_files.append(
-                "%s%s.tar.bz2" % (self.boost_release_name, self.archive_tag)
-            )
-            packages.append(
-                parallel_call(
-                    "tar",
-                    "--use-compress-program=lbzip2",
-                    "--exclude=ci_boost_common.py",
-                    "--exclude=ci_boost_release.py",
-                    "-cf",
-                    "%s%s.tar.bz2" % (self.boost_release_name, self.archive_tag),
-                    self.boost_release_name,
-                )
+            archive_files.extend(
+                "%s%s%s" % (self.boost_release_name, self.archive_tag, ext)
+                for ext, command in tar_compressors
             )
 
         # Create packages for CRLF style content.
         if self.eol == "CRLF":
+            # zip and 7z read the tree on their own, 7z can't read an archive
+            # from a stream.
+            self.make_release_tree()
             os.chdir(self.releases_dir)
-            archive_files.append(
-                "%s%s.zip" % (self.boost_release_name, self.archive_tag)
-            )
-            packages.append(
-                parallel_call(
-                    "zip",
-                    "-qr",
-                    "-9",
-                    "%s%s.zip" % (self.boost_release_name, self.archive_tag),
-                    self.boost_release_name,
-                    "-x",
-                    self.boost_release_name + "/ci_boost_common.py",
-                    self.boost_release_name + "/ci_boost_release.py",
+            # Both archivers run at the same time and share the CPU budget.
+            # zip is single threaded, so 7z gets the rest. In deterministic
+            # mode 7z gets a fixed number of threads instead, so that its
+            # output doesn't depend on the runner.
+            package_jobs = self.package_jobs or os.cpu_count() or self.jobs
+            if self.deterministic:
+                # The archivers are given sorted lists of what to pack, in a
+                # normalized tree.
+                sevenz_threads = 8
+                self.normalize_release_tree()
+                zip_list, sevenz_list = self.write_release_lists()
+                crlf_packages = [
+                    ("zip", ["zip", "-X", "-q", "-9"], ["-@"], zip_list),
+                    (
+                        "7z",
+                        [
+                            "7z",
+                            "a",
+                            "-bd",
+                            "-mx=7",
+                            "-mmt%s" % (sevenz_threads),
+                            "-ms=on",
+                            "-mtc=off",
+                            "-mta=off",
+                        ],
+                        ["@" + sevenz_list],
+                        None,
+                    ),
+                ]
+            else:
+                sevenz_threads = max(package_jobs - 1, 1)
+                crlf_packages = [
+                    ("zip", ["zip", "-qr", "-9"], [self.boost_release_name], None),
+                    (
+                        "7z",
+                        [
+                            "7z",
+                            "a",
+                            "-bd",
+                            "-mx=7",
+                            "-mmt%s" % (sevenz_threads),
+                            "-ms=on",
+                        ],
+                        [self.boost_release_name],
+                        None,
+                    ),
+                ]
+            with open(os.devnull, "w") as dev_null:
+                inputs = []
+                for ext, command, sources, source_list in crlf_packages:
+                    archive_file = "%s%s.%s" % (
+                        self.boost_release_name,
+                        self.archive_tag,
+                        ext,
+                    )
+                    archive_files.append(archive_file)
+                    inputs.append(open(source_list) if source_list else None)
+                    packages.append(
+                        parallel_call(
+                            *(command + [archive_file] + sources),
+                            stdin=inputs[-1],
+                            stdout=dev_null,
+                        )
+                    )
+                for package in packages:
+                    package.join()
+                for f in inputs:
+                    if f:
+                        f.close()
+            if self.deterministic:
+                utils.log(
+                    "Packaging with zip on 1 thread and 7z on %s threads"
+                    " (fixed for --deterministic):" % (sevenz_threads)
                 )
-            )
-            archive_files.append(
-                "%s%s.7z" % (self.boost_release_name, self.archive_tag)
-            )
-            with open("/dev/null") as dev_null:
-                utils.check_call(
-                    "7z",
-                    "a",
-                    "-bd",
-                    "-mx=7",
-                    "-mmt8",
-                    "-ms=on",
-                    "-x!" + self.boost_release_name + "/ci_boost_common.py",
-                    "-x!" + self.boost_release_name + "/ci_boost_release.py",
-                    "%s%s.7z" % (self.boost_release_name, self.archive_tag),
-                    self.boost_release_name,
-                    stdout=dev_null,
+            else:
+                utils.log(
+                    "Packaging with a CPU budget of %s, zip on 1 thread and 7z"
+                    " on %s threads:" % (package_jobs, sevenz_threads)
+                )
+            for (ext, command, sources, source_list), package in zip(
+                crlf_packages, packages
+            ):
+                utils.log(
+                    "    %s: %.1f seconds, %s CPU seconds"
+                    % (
+                        ext,
+                        package.wall_time,
+                        "?"
+                        if package.cpu_time is None
+                        else "%.1f" % (package.cpu_time),
+                    )
                 )
 
+        archive_hashes = {}
         for package in packages:
             package.join()
+            archive_hashes.update(getattr(package, "hashes", {}))
+
+        # The piped archives were hashed as they were written, hash the
+        # others in parallel.
+        with concurrent.futures.ThreadPoolExecutor(len(archive_files) or 1) as pool:
+            for archive_file, hashes in zip(
+                archive_files,
+                pool.map(
+                    lambda archive_file: archive_hashes.get(archive_file)
+                    or utils.file_hashes(archive_file, hash_names),
+                    archive_files,
+                ),
+            ):
+                archive_hashes[archive_file] = hashes
 
         # Create archive info data files.
+        created_date = ""
+        if self.commit_time() is not None:
+            created_date = time.strftime(
+                "%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.commit_time())
+            )
         for archive_file in archive_files:
-            sha256_sum = hashlib.sha256(open(archive_file, "rb").read()).hexdigest()
-            created_date = ""
-            try:
-                created_date = subprocess.check_output(
-                    "set -e && set -o pipefail; TZ=UTC git -C "
-                    + self.root_dir
-                    + " show -s --date='format-local:%Y-%m-%dT%H:%M:%SZ' "
-                    + self.commit
-                    + " | grep Date: | tr -s ' ' | cut -d' ' -f 2 ",
-                    universal_newlines=True,
-                    shell=True,
-                    executable="/bin/bash",
-                )
-                created_date = created_date.strip()
-            except:
-                print("Could not find the commit in the git log.")
-
             utils.make_file(
                 "%s.json" % (archive_file),
                 "{",
-                '"sha256":"%s",' % (sha256_sum),
+                *[
+                    '"%s":"%s",' % (hash_name, archive_hashes[archive_file][hash_name])
+                    for hash_name in hash_names
+                ],
                 '"file":"%s",' % (archive_file),
                 '"branch":"%s",' % (self.branch),
                 '"commit":"%s",' % (self.commit),
-                '"created":"%s"' % (created_date),
+                '"created":"%s",' % (created_date),
+                '"digest":"%s"' % (self.tree_digest()),
                 "}",
             )
 
@@ -854,9 +1066,6 @@ class script(script_common):
             ]
             utils.make_file(curl_cfg_rt, *curl_cfg_rt_data)
 
-        # # The uploads to the release services happen in parallel to minimize clock time.
-        # uploads = []
-
         # Prepare gh uploads
         if self.gh_token:
             os.chdir(os.path.dirname(self.root_dir))
@@ -928,79 +1137,510 @@ class script(script_common):
             # Finished with "prepare gh uploads". Set directory back to reasonable value.
             os.chdir(os.path.dirname(self.root_dir))
 
+        # Every (file, destination) upload runs on its own. See run_uploads.
+        uploads = []
         for filename in filenames:
-
             if "PRODUCTION_AWS_ACCESS_KEY_ID" in os.environ:
-                os.environ["AWS_ACCESS_KEY_ID"] = os.environ[
-                    "PRODUCTION_AWS_ACCESS_KEY_ID"
-                ]
-                os.environ["AWS_SECRET_ACCESS_KEY"] = os.environ[
-                    "PRODUCTION_AWS_SECRET_ACCESS_KEY"
-                ]
-                os.environ["AWS_DEFAULT_REGION"] = "us-east-2"
-                x = subprocess.run(
-                    [
-                        "aws",
+                uploads.append(
+                    (
                         "s3",
-                        "cp",
                         filename,
-                        "s3://boost-archives/" + self.branch + "/" + filename,
-                    ],
-                    stderr=sys.stderr,
-                    stdout=sys.stdout,
-                    bufsize=1,
-                    text=True,
+                        [
+                            "aws",
+                            "s3",
+                            "cp",
+                            "--only-show-errors",
+                            filename,
+                            "s3://boost-archives/" + self.branch + "/" + filename,
+                        ],
+                        {
+                            "env": dict(
+                                os.environ,
+                                AWS_ACCESS_KEY_ID=os.environ[
+                                    "PRODUCTION_AWS_ACCESS_KEY_ID"
+                                ],
+                                AWS_SECRET_ACCESS_KEY=os.environ[
+                                    "PRODUCTION_AWS_SECRET_ACCESS_KEY"
+                                ],
+                                AWS_DEFAULT_REGION="us-east-2",
+                            )
+                        },
+                    )
                 )
-
             if self.sf_releases_key:
-                # uploads.append(parallel_call(
-                utils.check_call(
-                    "curl",
-                    "sshpass",
-                    "-e",
-                    "rsync",
-                    "-e",
-                    "ssh",
-                    filename,
-                    "%s@frs.sourceforge.net:/home/frs/project/boost/boost/snapshots/%s/"
-                    % (os.environ["SSHUSER"], self.branch),
+                uploads.append(
+                    (
+                        "sourceforge",
+                        filename,
+                        [
+                            "sshpass",
+                            "-e",
+                            "rsync",
+                            "-e",
+                            "ssh",
+                            filename,
+                            "%s@frs.sourceforge.net:/home/frs/project/boost/boost/snapshots/%s/"
+                            % (os.environ["SSHUSER"], self.branch),
+                        ],
+                        {},
+                    )
                 )
             if self.artifactory_pass:
-                utils.check_call(
-                    "curl",
-                    "-K",
-                    curl_cfg_rt,
-                    "-T",
-                    filename,
-                    "https://"
-                    + self.artifactory_org
-                    + ".jfrog.io/artifactory/"
-                    + self.artifactory_repo
-                    + "/%s/%s" % (self.branch, filename),
+                uploads.append(
+                    (
+                        "artifactory",
+                        filename,
+                        [
+                            "curl",
+                            "--fail",
+                            "-K",
+                            curl_cfg_rt,
+                            "-T",
+                            filename,
+                            "https://"
+                            + self.artifactory_org
+                            + ".jfrog.io/artifactory/"
+                            + self.artifactory_repo
+                            + "/%s/%s" % (self.branch, filename),
+                        ],
+                        {},
+                    )
                 )
             if self.gh_token:
-                os.chdir(github_releases_folder)
-                utils.check_call(
-                    "gh",
-                    "release",
-                    "upload",
-                    "%s" % (github_release_name),
-                    "%s" % (os.path.join(os.path.dirname(self.root_dir), filename)),
-                    "--clobber",
+                uploads.append(
+                    (
+                        "github",
+                        filename,
+                        [
+                            "gh",
+                            "release",
+                            "upload",
+                            "%s" % (github_release_name),
+                            "%s"
+                            % (os.path.join(os.path.dirname(self.root_dir), filename)),
+                            "--clobber",
+                        ],
+                        {"cwd": github_releases_folder},
+                    )
                 )
-                os.chdir(os.path.dirname(self.root_dir))
-
-        # for upload in uploads:
-        #     upload.join()
+        # The info files go up only once all the uploads of their archives
+        # succeeded. Later builds trust the digest in them, see
+        # published_release_unchanged, so one must not be published with a
+        # missing or stale archive.
+        results = self.run_uploads(
+            [u for u in uploads if not u[1].endswith(".json")], tolerate_s3=True
+        )
+        failed = set(filename for _, filename, _, _, _, error in results if error)
+        for filename in sorted(failed):
+            utils.log("Not uploading %s.json, the archive upload failed." % (filename))
+        self.run_uploads(
+            [
+                u
+                for u in uploads
+                if u[1].endswith(".json") and u[1][: -len(".json")] not in failed
+            ]
+        )
 
         # Configuration after uploads, like setting uploaded file properties.
         for filename in filenames:
             if self.sf_releases_key:
                 pass
 
+    def run_uploads(self, uploads, tolerate_s3=False):
+        """
+        Run the (destination, filename, command, kargs) uploads on a pool of
+        upload_jobs workers, retrying each one on its own, and log a summary
+        by destination. Failures raise once all the uploads are done, except
+        S3 ones with tolerate_s3, which are only reported as they always
+        were for the archives. Returns the (destination, filename, attempts,
+        start, end, error) results.
+        """
+
+        def upload(destination, filename, command, kargs):
+            attempts = [0]
+
+            def upload_file():
+                attempts[0] += 1
+                utils.check_call(*command, **kargs)
+
+            start = time.time()
+            error = None
+            try:
+                utils.retry(upload_file, max_attempts=self.upload_retries)
+            except Exception as e:
+                error = e
+            return (destination, filename, attempts[0], start, time.time(), error)
+
+        with concurrent.futures.ThreadPoolExecutor(max(self.upload_jobs, 1)) as pool:
+            results = list(pool.map(lambda u: upload(*u), uploads))
+
+        summary = {}
+        for destination, filename, attempts, start, end, error in results:
+            done, failed, retries, first, last = summary.get(
+                destination, (0, 0, 0, start, end)
+            )
+            summary[destination] = (
+                done + (error is None),
+                failed + (error is not None),
+                retries + attempts - 1,
+                min(first, start),
+                max(last, end),
+            )
+            if error is not None:
+                utils.log(
+                    "Upload of %s to %s failed: %s" % (filename, destination, error)
+                )
+        utils.log("Uploads:")
+        for destination, (done, failed, retries, first, last) in sorted(
+            summary.items()
+        ):
+            utils.log(
+                "    %s: %d uploaded, %d failed, %d retries, %.1f seconds"
+                % (destination, done, failed, retries, last - first)
+            )
+        for destination, filename, attempts, start, end, error in results:
+            if error is not None and not (tolerate_s3 and destination == "s3"):
+                raise error
+        return results
+
+    def tar_extensions(self):
+        """The extensions of the tar archives to make, from --tar-formats."""
+
+        extensions = []
+        for ext in self.tar_formats.split(","):
+            ext = ext.strip()
+            if not ext:
+                continue
+            if not ext.startswith("."):
+                ext = "." + ext
+            if not ext.startswith(".tar."):
+                ext = ".tar" + ext
+            if ext not in self.tar_compressors:
+                raise Exception(
+                    "Unknown tar format '%s', known formats are: %s"
+                    % (ext, ", ".join(sorted(self.tar_compressors)))
+                )
+            extensions.append(ext)
+        return extensions
+
+    def archive_extensions(self):
+        """The extensions of the archives made for the EOL style."""
+
+        if self.eol == "LF":
+            return self.tar_extensions()
+        return [".zip", ".7z"]
+
+    def tree_digest(self):
+        """
+        A digest of everything the archives are made from: the tree, with
+        the submodule commits, the website-v2-docs commit of the antora docs,
+        the release scripts, the packaging settings and the versions of
+        the tools. It is recorded in the archive info files.
+        """
+
+        if not hasattr(self, "_tree_digest"):
+            digest = hashlib.sha256()
+            # The tree includes the commits of the submodules, and theirs
+            # of their own submodules.
+            digest.update(
+                subprocess.check_output(
+                    ["git", "rev-parse", "HEAD^{tree}"], cwd=self.root_dir
+                )
+            )
+            script_dir = os.path.dirname(os.path.abspath(__file__))
+            for name in [
+                "ci_boost_release.py",
+                "ci_boost_common.py",
+                "MakeBoostDistro.py",
+            ]:
+                path = os.path.join(script_dir, name)
+                if os.path.isfile(path):
+                    digest.update(
+                        ("%s %s\n" % (name, utils.file_hashes(path)["sha256"])).encode()
+                    )
+            settings = [
+                self.eol,
+                self.boost_release_name,
+                self.archive_tag,
+                ",".join(self.archive_extensions()),
+                self.archive_hashes,
+                str(self.deterministic),
+            ]
+            digest.update(("\n".join(settings) + "\n").encode())
+            digest.update(("antora %s\n" % (self.antora_revision())).encode())
+            for command in self.tool_version_commands:
+                digest.update(("%s\n" % (self.tool_version(command))).encode())
+            self._tree_digest = digest.hexdigest()
+        return self._tree_digest
+
+    def tool_version(self, command):
+        """
+        The version of a tool, as printed by the command: the first line of
+        the output with a version number, up to the number. The rest of the
+        output can change from host to host, 7z prints the locale and the
+        CPUs for instance.
+        """
+
+        try:
+            process = subprocess.Popen(
+                command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+            )
+            output = process.communicate()[0].decode("utf-8", "replace")
+        except OSError:
+            return "%s missing" % (command[0])
+        lines = [line.strip() for line in output.splitlines() if line.strip()]
+        for line in lines:
+            version = re.match(r".*?\d+(\.\d+)+", line)
+            if version:
+                return version.group(0)
+        return lines[0] if lines else ""
+
+    def antora_branch(self):
+        """The branch of website-v2-docs the antora docs are built with."""
+
+        if self.branch == "master":
+            return "master"
+        return "develop"
+
+    def antora_checkout(self):
+        """
+        Clone website-v2-docs, the antora docs project, in the build dir if
+        it isn't there yet, and return its directory.
+        """
+
+        antora_dir = os.path.join(self.build_dir, "antora")
+        if not os.path.exists(antora_dir):
+            utils.makedirs(self.build_dir)
+            utils.check_call(
+                "git",
+                "clone",
+                "--depth=1",
+                "--branch=%s" % self.antora_branch(),
+                "https://github.com/boostorg/website-v2-docs.git",
+                antora_dir,
+            )
+        return antora_dir
+
+    def antora_revision(self):
+        """
+        The commit of website-v2-docs the antora docs are built with, the
+        one checked out in the build dir. It is cloned now if need be, so
+        that the docs are built from this very commit.
+        """
+
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"], cwd=self.antora_checkout()
+            )
+            .decode("utf-8")
+            .strip()
+        )
+
+    def resolve_branch(self):
+        """
+        Set the branch from the checkout when it isn't given: the current
+        branch, or develop.
+        """
+
+        if self.branch is None:
+            self.branch = "develop"
+            output = subprocess.check_output(
+                ["git", "branch", "--show-current"], cwd=self.root_dir
+            ).decode("utf-8")
+            lines = output.split("\n")
+            for line in lines:
+                if len(line) > 0:
+                    self.branch = line
+                    break
+
+    def published_release_unchanged(self):
+        """
+        Whether the archives published for the branch were made from the
+        same tree, by the tree digest in their info files.
+        """
+
+        if self.force or self.mode != "build":
+            return False
+        if self.branch not in ["master", "develop"]:
+            return False
+        for ext in self.archive_extensions():
+            url = "%s/%s/%s%s%s.json" % (
+                self.archives_url,
+                self.branch,
+                self.boost_release_name,
+                self.archive_tag,
+                ext,
+            )
+            try:
+                response = urlopen(url, timeout=60)
+                info = json.loads(response.read().decode("utf-8"))
+                response.close()
+            except Exception as e:
+                utils.log("Could not read %s: %s" % (url, e))
+                return False
+            if info.get("digest") != self.tree_digest():
+                return False
+        utils.log(
+            "The published snapshot was made from the same tree (%s)."
+            " Set FORCE=1 to build it anyway." % (self.tree_digest())
+        )
+        return True
+
+    def write_tar(self, stream):
+        """Write the release tree as an uncompressed tar stream."""
+
+        mtime = self.commit_time() if self.deterministic else None
+        if self.distro_plan:
+            import MakeBoostDistro
+
+            MakeBoostDistro.WriteTar(self.distro_plan, stream, mtime)
+            return
+        command = ["tar", "-cf", "-", self.boost_release_name]
+        if mtime is not None:
+            command[1:1] = [
+                "--format=gnu",
+                "--sort=name",
+                "--mtime=@%s" % (mtime),
+                "--clamp-mtime",
+                "--owner=0",
+                "--group=0",
+                "--numeric-owner",
+                "--mode=u+rw,go+r,go-w,a+X",
+            ]
+        utils.log("%s> '%s'" % (os.getcwd(), "' '".join(command)))
+        tar = subprocess.Popen(command, stdout=subprocess.PIPE)
+        shutil.copyfileobj(tar.stdout, stream, 1024 * 1024)
+        tar.stdout.close()
+        result = tar.wait()
+        if result != 0:
+            raise SystemCallError(command, result)
+
+    def commit_time(self):
+        """
+        The author date of the commit as a unix time, or None if git
+        doesn't know it.
+        """
+
+        if not hasattr(self, "_commit_time"):
+            self._commit_time = None
+            try:
+                self._commit_time = int(
+                    subprocess.check_output(
+                        ["git", "-C", self.root_dir, "show", "-s", "--format=%at"]
+                        + [self.commit],
+                        universal_newlines=True,
+                    ).strip()
+                )
+            except:
+                print("Could not find the commit in the git log.")
+        return self._commit_time
+
+    def normalize_release_tree(self):
+        """
+        Clamp the mtimes in the release tree to the commit date and give
+        everything 0755 or 0644 permissions, for deterministic archives.
+        The tree must not share its files with the checkout, see
+        make_release_tree.
+        """
+
+        mtime = self.commit_time()
+        for root, dirs, files in os.walk(
+            os.path.join(self.releases_dir, self.boost_release_name), topdown=False
+        ):
+            for path in [os.path.join(root, name) for name in files] + [root]:
+                st = os.lstat(path)
+                if stat.S_ISLNK(st.st_mode):
+                    continue
+                if stat.S_ISDIR(st.st_mode) or st.st_mode & 0o111:
+                    os.chmod(path, 0o755)
+                else:
+                    os.chmod(path, 0o644)
+                if mtime is not None and st.st_mtime > mtime:
+                    os.utime(path, (mtime, mtime))
+
+    def write_release_lists(self):
+        """
+        Write the sorted lists of the release tree for zip, with every file
+        and directory, and for 7z, with the files and empty directories as 7z
+        adds the contents of a directory. Returns the paths of the lists.
+        """
+
+        zip_entries = []
+        sevenz_entries = []
+        os.chdir(self.releases_dir)
+        for root, dirs, files in os.walk(self.boost_release_name):
+            zip_entries.append(root + "/")
+            if not dirs and not files:
+                sevenz_entries.append(root)
+            for name in files:
+                zip_entries.append(os.path.join(root, name))
+                sevenz_entries.append(os.path.join(root, name))
+        lists = []
+        for ext, entries in [("zip", zip_entries), ("7z", sevenz_entries)]:
+            path = os.path.join(
+                self.build_dir, "%s.%s.list" % (self.boost_release_name, ext)
+            )
+            utils.make_file(path, *sorted(entries))
+            lists.append(path)
+        return lists
+
+    def import_distro(self):
+        """
+        Import MakeBoostDistro, which is run in-process. Use the copy that
+        sits next to this script, and only fetch it when this script was
+        copied alone.
+        """
+
+        distro_dir = os.path.dirname(os.path.abspath(__file__))
+        if not os.path.isfile(os.path.join(distro_dir, "MakeBoostDistro.py")):
+            distro_dir = self.build_dir
+            os.chdir(distro_dir)
+            utils.check_call(
+                "wget",
+                "https://raw.githubusercontent.com/boostorg/release-tools/master/MakeBoostDistro.py",
+                "-O",
+                "MakeBoostDistro.py",
+            )
+        if distro_dir not in sys.path:
+            sys.path.insert(0, distro_dir)
+        import MakeBoostDistro
+
+        return MakeBoostDistro
+
+    def distro_manifest_wanted(self):
+        """
+        Whether the release tree gets a manifest. It is read by
+        --distro-incremental=hash, for the hashes of the previous tree, and
+        by the website upload of the LF tree, see website_sync.
+        """
+
+        return self.distro_incremental == "hash" or self.eol == "LF"
+
+    def make_release_tree(self):
+        """
+        Hardlink the planned release tree from the checkout, in stream mode.
+        In deterministic mode the tree is normalized, see
+        normalize_release_tree, so it is reflinked or copied instead, to
+        leave the checkout as it is.
+        """
+
+        if self.distro_plan is None:
+            return
+        os.chdir(self.releases_dir)
+        if not os.path.isdir(self.boost_release_name):
+            hash_name = "md5" if self.distro_manifest_wanted() else None
+            self.distro_plan.execute(
+                self.jobs, "reflink" if self.deterministic else "hardlink", hash_name
+            )
+            if hash_name:
+                self.distro_plan.manifest(self.boost_release_name, hash_name).write(
+                    self.distro_manifest_file
+                )
+
     def website_upload_to_s3(self):
         """Upload the contents of the archive to S3 for website hosting."""
 
+        self.make_release_tree()
         os.chdir(os.path.dirname(self.root_dir))
 
         # if not shutil.which("aws"):
@@ -1057,29 +1697,110 @@ region = us-east-2
                     ["date"], stderr=sys.stderr, stdout=sys.stdout, bufsize=1, text=True
                 )
                 print(x)
-                x = subprocess.run(
-                    [
-                        "rclone",
-                        "sync",
-                        "--checksum",
-                        self.boost_release_name + "/",
-                        "remote1:"
-                        + os.environ["S3_BUCKET"]
-                        + "/archives/"
-                        + self.branch
-                        + "/",
-                    ],
-                    stderr=sys.stderr,
-                    stdout=sys.stdout,
-                    bufsize=1,
-                    text=True,
+                self.website_sync(
+                    "remote1:"
+                    + os.environ["S3_BUCKET"]
+                    + "/archives/"
+                    + self.branch
+                    + "/"
                 )
-                print(x)
                 x = subprocess.run(
                     ["date"], stderr=sys.stderr, stdout=sys.stdout, bufsize=1, text=True
                 )
                 print(x)
 
+    def website_sync(self, remote):
+        """
+        Make remote the same as the release tree. With the manifest of the
+        tree, the local files aren't hashed again: the md5 of the manifest
+        are compared with those rclone lists for the remote, and only the
+        files that differ are copied or deleted. Without it, or when it
+        can't be used, rclone sync does it all.
+        """
+
+        manifest_file = "%s.manifest.json" % (self.boost_release_name)
+        local_files = None
+        if os.path.isfile(manifest_file):
+            try:
+                local_files = {}
+                manifest = self.import_distro().ReadManifest(manifest_file)
+                for entry in manifest:
+                    path = os.path.join(manifest.root, entry.path)
+                    st = os.stat(path)
+                    # A file changed since is hashed again.
+                    if (
+                        entry.hash
+                        and manifest.hash_name == "md5"
+                        and st.st_size == entry.size
+                        and int(st.st_mtime) == entry.mtime
+                    ):
+                        local_files[entry.path] = (entry.size, entry.hash)
+                    else:
+                        local_files[entry.path] = (
+                            st.st_size,
+                            utils.file_hashes(path, ["md5"])["md5"],
+                        )
+                lsjson = subprocess.check_output(
+                    ["rclone", "lsjson", "-R", "--files-only", "--hash"]
+                    + ["--hash-type", "MD5", remote],
+                    universal_newlines=True,
+                )
+            except Exception as e:
+                utils.log("Not using the manifest of the release tree: %s" % (e))
+                local_files = None
+        if local_files is None:
+            x = subprocess.run(
+                [
+                    "rclone",
+                    "sync",
+                    "--checksum",
+                    self.boost_release_name + "/",
+                    remote,
+                ],
+                stderr=sys.stderr,
+                stdout=sys.stdout,
+                bufsize=1,
+                text=True,
+            )
+            print(x)
+            return
+
+        remote_files = dict(
+            (e["Path"], (e["Size"], e.get("Hashes", {}).get("md5", "")))
+            for e in json.loads(lsjson or "[]")
+        )
+        # Without a remote md5, the sizes are compared, as rclone does.
+        upload = sorted(
+            path
+            for path, (size, md5) in local_files.items()
+            if path not in remote_files
+            or remote_files[path][0] != size
+            or (remote_files[path][1] and remote_files[path][1] != md5)
+        )
+        delete = sorted(path for path in remote_files if path not in local_files)
+        utils.log(
+            "%s: %d files to upload, %d to delete, %d unchanged"
+            % (remote, len(upload), len(delete), len(local_files) - len(upload))
+        )
+        # Delete after the upload, as rclone sync does.
+        for command, paths in [
+            (["copy", "--checksum", "--no-traverse", self.boost_release_name], upload),
+            (["delete"], delete),
+        ]:
+            if not paths:
+                continue
+            files_from = os.path.join(self.build_dir, "website-%s.list" % (command[0]))
+            utils.make_file(files_from, *paths)
+            utils.check_call(
+                "rclone",
+                *(
+                    command[:1]
+                    + ["--files-from-raw", files_from]
+                    + command[1:]
+                    + [remote]
+                ),
+            )
+
     def command_after_success(self):
         super(script, self).command_after_success()
         # Publish created packages depending on the EOL style and branch.
@@ -1090,22 +1811,21 @@ region = us-east-2
         if self.mode == "check":
             return
 
-        if self.eol == "LF":
-            os.chdir(os.path.dirname(self.root_dir))
-            self.upload_archives(
-                "%s%s.tar.gz" % (self.boost_release_name, self.archive_tag),
-                "%s%s.tar.gz.json" % (self.boost_release_name, self.archive_tag),
-                "%s%s.tar.bz2" % (self.boost_release_name, self.archive_tag),
-                "%s%s.tar.bz2.json" % (self.boost_release_name, self.archive_tag),
+        # The build may have been run by another process, see command_build.
+        if self.release_unchanged or self.published_release_unchanged():
+            utils.log("The published snapshot is up to date, not uploading.")
+            return
+
+        os.chdir(os.path.dirname(self.root_dir))
+        archive_files = []
+        for ext in self.archive_extensions():
+            archive_files.append(
+                "%s%s%s" % (self.boost_release_name, self.archive_tag, ext)
             )
-        if self.eol == "CRLF":
-            os.chdir(os.path.dirname(self.root_dir))
-            self.upload_archives(
-                "%s%s.zip" % (self.boost_release_name, self.archive_tag),
-                "%s%s.zip.json" % (self.boost_release_name, self.archive_tag),
-                "%s%s.7z" % (self.boost_release_name, self.archive_tag),
-                "%s%s.7z.json" % (self.boost_release_name, self.archive_tag),
+            archive_files.append(
+                "%s%s%s.json" % (self.boost_release_name, self.archive_tag, ext)
             )
+        self.upload_archives(*archive_files)
 
         self.website_upload_to_s3()
 
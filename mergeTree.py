@@ -63,5 +63,11 @@ def mergetree(src, dst, symlinks=False, ignore=None):
 
 if len(sys.argv) == 3:
     mergetree(sys.argv[1], sys.argv[2])
+elif len(sys.argv) == 5 and sys.argv[1] == "--ignore-file":
+    # Leave out what MakeBoostDistro leaves out, plus the patterns in the file.
+    from MakeBoostDistro import IgnoreFiles, ReadIgnoreFile
+
+    ignore = IgnoreFiles.extend(ReadIgnoreFile(sys.argv[2]))
+    mergetree(sys.argv[3], sys.argv[4], ignore=ignore)
 else:
-    print("Usage %s <source> <dest>" % sys.argv[0])
+    print("Usage %s [--ignore-file <file>] <source> <dest>" % sys.argv[0])
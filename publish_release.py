@@ -28,17 +28,27 @@
 # ./publish_release.py 1_76_0 -r 1       # publishes 1_76_0_rc1
 # ./publish_release.py 1_76_0 -b 2       # publishes 1_76_0_b2
 # ./publish_release.py 1_76_0 -b 4 -r 2  # publishes 1_76_0_b4_rc2
+#
+# The completed stages are recorded in boost_X_YY_Z.journal.json. If the
+# script is run again, the stages whose files are still there and
+# unchanged are skipped. --restart runs every stage, and --redo runs the
+# listed stages again.
 
 from optparse import OptionParser
 import requests
+import concurrent.futures
 import shutil
 import urllib
 import hashlib
 import re, os, sys
 import json
+import asyncio
+import tarfile
+import zipfile
 from pathlib import Path
 import subprocess
 import pathlib
+import tempfile
 import time
 
 # run: pip3 install python-dotenv
@@ -47,10 +57,20 @@ from dotenv import load_dotenv
 jfrogURL = "https://boostorg.jfrog.io/artifactory/"
 fastlyURL = "https://archives.boost.io/"
 s3_archives_bucket = "boost-archives"
+# Number of files uploaded to S3 at the same time, in one rclone session.
+s3UploadTransfers = 8
+# Number of files uploaded at the same time by the website upload, shared
+# by all the buckets.
+websiteSyncTransfers = 48
 aws_profile = "production"
 # git tag settings:
 boost_repo_url = "git@github.com:boostorg/boost.git"
 boost_branch = "master"
+# Number of submodule tag pushes run at the same time, and times each is retried.
+tagPushJobs = 16
+tagPushRetries = 3
+# Seconds each preflight check may take.
+preflightTimeout = 30
 
 # webhook settings:
 boost_websites = ["https://www.boost.org", "https://www.stage.boost.org"]
@@ -58,13 +78,35 @@ boost_websites = ["https://www.boost.org", "https://www.stage.boost.org"]
 # defaults, used later
 stagingPath2 = ""
 checksum_succeeded = True
+# The journal of the completed stages, kept in journalFile.
+journal = {}
+journalFile = ""
+
+# download settings:
+# Files larger than two segments are downloaded in parallel segments.
+downloadSegmentSize = 32 * 1024 * 1024
+downloadJobs = 8
+downloadRetries = 5
+# One pooled session for all the downloads. Ask for the files as they
+# are, so that the sizes and ranges are those of the files.
+downloadSession = requests.Session()
+downloadSession.mount(
+    "https://",
+    requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=downloadJobs),
+)
+downloadSession.headers["Accept-Encoding"] = "identity"
+# The sha256 of the downloaded files by absolute path, hashed as they
+# were downloaded.
+downloadHashes = {}
 
 
 def fileHash(fileName):
+    if os.path.abspath(fileName) in downloadHashes:
+        return downloadHashes[os.path.abspath(fileName)]
     sha256_hash = hashlib.sha256()
     with open(fileName, "rb") as f:
-        # Read and update hash string value in blocks of 4K
-        for byte_block in iter(lambda: f.read(4096), b""):
+        # Read and update hash string value in blocks of 1M
+        for byte_block in iter(lambda: f.read(1024 * 1024), b""):
             sha256_hash.update(byte_block)
     return sha256_hash.hexdigest()
 
@@ -97,14 +139,159 @@ def genJSON(snapshotJSON, fileName, incomingSHA, nodocs=False):
     return newJSON
 
 
-# Copied from https://stackoverflow.com/questions/16694907/download-large-file-in-python-with-requests
-def downloadAFile(url, destFile):
-    if os.path.exists(destFile) and options.skip_redownloading:
+def downloadRange(url, partFile, start, end=None, onData=None):
+    # Download the bytes start to end (inclusive, or to the end of the file
+    # when end is None) of url into partFile at the same offset. A dropped
+    # connection is retried from the byte where it stopped. onData(offset,
+    # data) is called with everything written.
+    offset = start
+    for attempt in range(downloadRetries + 1):
+        try:
+            headers = {}
+            if offset > 0 or end is not None:
+                headers["Range"] = f"bytes={offset}-{'' if end is None else end}"
+            with downloadSession.get(
+                url, headers=headers, stream=True, timeout=60
+            ) as r:
+                r.raise_for_status()
+                if headers and r.status_code != 206:
+                    if end is not None:
+                        raise Exception(f"{url} was not sent from byte {offset}")
+                    # The whole file was sent, start over.
+                    offset = 0
+                with open(partFile, "r+b") as f:
+                    f.seek(offset)
+                    if end is None:
+                        f.truncate()
+                    for chunk in r.iter_content(chunk_size=1024 * 1024):
+                        f.write(chunk)
+                        if onData:
+                            onData(offset, chunk)
+                        offset += len(chunk)
+            if end is None or offset == end + 1:
+                return
+            raise Exception(f"{url} stopped at byte {offset}")
+        except Exception as e:
+            if attempt == downloadRetries:
+                raise
+            print(f"Download of {url} failed: {e}. Retrying from byte {offset}.")
+            time.sleep(2**attempt)
+
+
+def downloadAFile(url, destFile, expectedHash=None):
+    # The file is hashed while it is downloaded, and the download fails
+    # as soon as it is complete if the sha256 isn't expectedHash.
+    # Check the size and whether ranges are supported first.
+    r = downloadSession.head(url, allow_redirects=True, timeout=60)
+    r.raise_for_status()
+    size = int(r.headers.get("Content-Length", -1))
+    ranges = r.headers.get("Accept-Ranges", "") == "bytes"
+    if (
+        os.path.exists(destFile)
+        and options.skip_redownloading
+        and (size < 0 or os.path.getsize(destFile) == size)
+    ):
         print(f"{destFile} already present. Skipping the download.")
+        downloadHashes.pop(os.path.abspath(destFile), None)
+        sha256 = fileHash(destFile)
+        if not checkDownloadHash(destFile, sha256, expectedHash):
+            print(f"Remove {destFile}, or run without --skip-redownloading.")
+            exit(1)
+        downloadHashes[os.path.abspath(destFile)] = sha256
+        return
+
+    # The download goes to destFile.part, and what is there is resumed.
+    # Segmented downloads list the finished segments in destFile.part.done.
+    partFile = destFile + ".part"
+    doneFile = partFile + ".done"
+
+    # The hash follows the downloaded bytes in order. Data that isn't
+    # received in order, resumed or in later segments, is read back from
+    # partFile once the bytes before it are hashed.
+    hashState = {"hash": hashlib.sha256(), "hashed": 0}
+
+    def hashTo(end):
+        with open(partFile, "rb") as f:
+            f.seek(hashState["hashed"])
+            while hashState["hashed"] < end:
+                block = f.read(min(1024 * 1024, end - hashState["hashed"]))
+                if not block:
+                    break
+                hashState["hash"].update(block)
+                hashState["hashed"] += len(block)
+
+    def onData(offset, data):
+        if offset != hashState["hashed"]:
+            # The download started over.
+            hashState["hash"] = hashlib.sha256()
+            hashState["hashed"] = 0
+            hashTo(offset)
+        hashState["hash"].update(data)
+        hashState["hashed"] += len(data)
+
+    if size >= 2 * downloadSegmentSize and ranges:
+        done = set()
+        if os.path.exists(partFile) and os.path.exists(doneFile):
+            with open(doneFile) as f:
+                done = set(int(line) for line in f if line.strip())
+        if not os.path.exists(partFile) or os.path.getsize(partFile) != size:
+            done = set()
+            with open(partFile, "wb") as f:
+                f.truncate(size)
+        with open(doneFile, "w") as f:
+            f.write("".join(f"{start}\n" for start in sorted(done)))
+        segments = [
+            (start, min(start + downloadSegmentSize, size) - 1)
+            for start in range(0, size, downloadSegmentSize)
+            if start not in done
+        ]
+        with concurrent.futures.ThreadPoolExecutor(downloadJobs) as pool:
+            futures = {
+                pool.submit(downloadRange, url, partFile, start, end): start
+                for start, end in segments
+            }
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+                with open(doneFile, "a") as f:
+                    f.write(f"{futures[future]}\n")
+                done.add(futures[future])
+                while hashState["hashed"] in done:
+                    hashTo(min(hashState["hashed"] + downloadSegmentSize, size))
     else:
-        with requests.get(url, stream=True) as r:
-            with open(destFile, "wb") as f:
-                shutil.copyfileobj(r.raw, f)
+        start = 0
+        if os.path.exists(partFile) and not os.path.exists(doneFile) and ranges:
+            start = os.path.getsize(partFile)
+        if start == 0 or (size >= 0 and start > size):
+            start = 0
+            open(partFile, "wb").close()
+        hashTo(start)
+        if size < 0 or start < size:
+            downloadRange(url, partFile, start, onData=onData)
+
+    if size >= 0 and os.path.getsize(partFile) != size:
+        print(
+            f"ERROR: {destFile} is {os.path.getsize(partFile)} bytes, expected {size}"
+        )
+        exit(1)
+    hashTo(os.path.getsize(partFile))
+    if not checkDownloadHash(destFile, hashState["hash"].hexdigest(), expectedHash):
+        os.remove(partFile)
+        if os.path.exists(doneFile):
+            os.remove(doneFile)
+        exit(1)
+    os.replace(partFile, destFile)
+    if os.path.exists(doneFile):
+        os.remove(doneFile)
+    downloadHashes[os.path.abspath(destFile)] = hashState["hash"].hexdigest()
+
+
+def checkDownloadHash(fileName, sha256, expectedHash):
+    if expectedHash is not None and sha256 != expectedHash:
+        print("ERROR: Checksum failure for '%s'" % fileName)
+        print("Recorded:	%s" % expectedHash)
+        print("Calculated: %s" % sha256)
+        return False
+    return True
 
 
 def downloadJFROGFiles(sourceRepo, sourceFileName, destFileName, suffix):
@@ -126,13 +313,16 @@ def downloadFASTLYFiles(sourceFileName, destFileName, suffix):
     #           boost_X_YY_ZZ-snapshot.Q      -> boost_X_YY_ZZ.Q
     #           boost_X_YY_ZZ-snapshot.Q.json -> boost_X_YY_ZZ-snapshot.Q.json
 
+    # The json comes first, so that the archive is checked as it arrives.
     sourceFile = "%s%s" % (sourceFileName, suffix)
     destFile = "%s%s" % (destFileName, suffix)
     jsonFile = "%s.json" % sourceFile
-    print("Downloading: %s to %s" % (sourceFile, destFile))
-    downloadAFile(fastlyURL + "master/" + sourceFile, destFile)
     print("Downloading: %s to %s" % (jsonFile, jsonFile))
     downloadAFile(fastlyURL + "master/" + jsonFile, jsonFile)
+    with open(jsonFile, "r") as f:
+        expectedHash = json.load(f)["sha256"]
+    print("Downloading: %s to %s" % (sourceFile, destFile))
+    downloadAFile(fastlyURL + "master/" + sourceFile, destFile, expectedHash)
 
 
 def copyJFROGFile(sourceRepo, sourceFileName, destRepo, destFileName, suffix):
@@ -150,21 +340,168 @@ def uploadJFROGFile(sourceFileName, destRepo):
     os.system("jfrog rt upload %s %s" % (sourceFileName, destRepo))
 
 
-def uploadS3File(sourceFileName, destRepo):
-    # 	Upload an archive to S3
-    print("Uploading: %s to S3" % (sourceFileName))
-    archivePathLocal = sourceFileName
+def uploadS3Files(sourceFileNames, destRepo):
+    # 	Upload archives to S3, one rclone session for the files of each
+    # 	directory, s3UploadTransfers at a time. Prints a result by file, and
+    # 	raises CalledProcessError if any failed.
     archivePathRemote = re.sub("^main/", "", destRepo)
     archivePathRemote = "remote1:" + s3_archives_bucket + "/" + archivePathRemote
+    sourceDirs = {}
+    for sourceFileName in sourceFileNames:
+        sourceDir, name = os.path.split(os.path.abspath(sourceFileName))
+        sourceDirs.setdefault(sourceDir, []).append(name)
+    for sourceDir, names in sourceDirs.items():
+        print("Uploading: %d files from %s to S3" % (len(names), sourceDir))
+        with tempfile.NamedTemporaryFile("w", suffix=".txt") as listFile:
+            listFile.writelines(name + "\n" for name in names)
+            listFile.flush()
+            result = subprocess.run(
+                [
+                    "rclone",
+                    "-v",
+                    "--use-json-log",
+                    "--s3-no-check-bucket",
+                    "copy",
+                    "--checksum",
+                    "--no-traverse",
+                    "--transfers",
+                    str(s3UploadTransfers),
+                    "--files-from-raw",
+                    listFile.name,
+                    sourceDir,
+                    archivePathRemote,
+                ],
+                env=dict(os.environ, AWS_PROFILE=aws_profile),
+                stderr=subprocess.PIPE,
+                text=True,
+            )
+        # Without a log line a file was already there, unchanged.
+        results = dict((name, "unchanged") for name in names)
+        for line in result.stderr.splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                print(line)
+                continue
+            name = entry.get("object")
+            if name not in results:
+                if entry.get("level") == "error" or options.progress:
+                    print(entry.get("msg", line))
+            elif entry.get("level") == "error":
+                results[name] = "FAILED: " + entry.get("msg", "").strip()
+            elif entry.get("msg", "").startswith("Copied"):
+                results[name] = entry["msg"].strip()
+        width = max(len(name) for name in names)
+        for name in names:
+            print(f"    {name:<{width}}  {results[name]}")
+        result.check_returncode()
+
+
+def hashTree(treeDir):
+    # The size and md5 of every file under treeDir, by path relative to
+    # treeDir, hashed in parallel.
+    fileNames = []
+    for root, dirs, files in os.walk(treeDir):
+        for name in files:
+            fileNames.append(os.path.relpath(os.path.join(root, name), treeDir))
+
+    def hashFile(fileName):
+        md5_hash = hashlib.md5()
+        with open(os.path.join(treeDir, fileName), "rb") as f:
+            for byte_block in iter(lambda: f.read(1024 * 1024), b""):
+                md5_hash.update(byte_block)
+        return (os.path.getsize(os.path.join(treeDir, fileName)), md5_hash.hexdigest())
+
+    with concurrent.futures.ThreadPoolExecutor(2 * (os.cpu_count() or 1)) as pool:
+        return dict(zip(fileNames, pool.map(hashFile, fileNames)))
+
+
+def syncBucket(treeDir, localFiles, profile, remote, transfers):
+    # Make remote the same as treeDir, whose files are localFiles as made
+    # by hashTree, like 'rclone sync --checksum' would. Returns an error
+    # message, or None.
+    env = dict(os.environ, AWS_PROFILE=profile)
     result = subprocess.run(
-        "export AWS_PROFILE=%s;rclone -v --s3-no-check-bucket copy --checksum %s %s"
-        % (aws_profile, archivePathLocal, archivePathRemote),
-        check=True,
-        shell=True,
+        [
+            "rclone",
+            "lsjson",
+            "-R",
+            "--files-only",
+            "--hash",
+            "--hash-type",
+            "MD5",
+            remote,
+        ],
+        env=env,
+        capture_output=True,
         text=True,
     )
-    if options.progress:
-        print(result)
+    if result.returncode != 0:
+        return f"rclone lsjson {remote} failed: {result.stderr.strip()}"
+    remoteFiles = dict(
+        (entry["Path"], (entry["Size"], entry.get("Hashes", {}).get("md5", "")))
+        for entry in json.loads(result.stdout or "[]")
+    )
+    # Without a remote md5, the sizes are compared, as rclone does.
+    upload = [
+        name
+        for name, (size, md5) in localFiles.items()
+        if name not in remoteFiles
+        or remoteFiles[name][0] != size
+        or (remoteFiles[name][1] and remoteFiles[name][1] != md5)
+    ]
+    delete = [name for name in remoteFiles if name not in localFiles]
+    print(f"{remote}: {len(upload)} files to upload, {len(delete)} to delete.")
+
+    with tempfile.TemporaryDirectory() as listDir:
+        commands = []
+        if upload:
+            commands.append(
+                ["copy", "--checksum", "--no-traverse", "--transfers", str(transfers)]
+                + ["--files-from-raw", os.path.join(listDir, "upload.txt")]
+                + [treeDir, remote]
+            )
+            with open(os.path.join(listDir, "upload.txt"), "w") as f:
+                f.writelines(name + "\n" for name in upload)
+        if delete:
+            commands.append(
+                ["delete", "--checkers", str(transfers)]
+                + ["--files-from-raw", os.path.join(listDir, "delete.txt"), remote]
+            )
+            with open(os.path.join(listDir, "delete.txt"), "w") as f:
+                f.writelines(name + "\n" for name in delete)
+        # Delete after the upload, as rclone sync does.
+        for command in commands:
+            result = subprocess.run(
+                ["rclone", "--s3-no-check-bucket"] + command,
+                env=env,
+                capture_output=True,
+                text=True,
+            )
+            if result.returncode != 0:
+                return (
+                    f"rclone {command[0]} to {remote} failed: {result.stderr.strip()}"
+                )
+    return None
+
+
+def syncWebsiteBuckets(treeDir, remotes):
+    # Sync treeDir to all the remotes, a list of (aws profile, remote), at
+    # the same time. The local tree is hashed once for all of them, and
+    # they share websiteSyncTransfers. Returns whether they all succeeded.
+    print(f"Hashing {treeDir}")
+    localFiles = hashTree(treeDir)
+    transfers = max(1, websiteSyncTransfers // len(remotes))
+    with concurrent.futures.ThreadPoolExecutor(len(remotes)) as pool:
+        errors = list(
+            pool.map(
+                lambda r: syncBucket(treeDir, localFiles, r[0], r[1], transfers),
+                remotes,
+            )
+        )
+    for (profile, remote), error in zip(remotes, errors):
+        print(f"    {remote}  {'FAILED: ' + error if error else 'ok'}")
+    return not any(errors)
 
 
 def copyStagingS3():
@@ -190,6 +527,187 @@ def copyStagingS3():
         print(result)
 
 
+# The doc directories left out of the nodocs archives. The same as
+# 'rm -rf libs/*/doc libs/numeric/*/doc tools/*/doc doc/' in the tree.
+nodocsPattern = re.compile(
+    r"^[^/]+/(libs/[^/]+/doc|libs/numeric/[^/]+/doc|tools/[^/]+/doc|doc)(/|$)"
+)
+
+# The compressors of the tar archives, by suffix. They decompress with -dc.
+tarCompressors = {
+    ".tar.gz": ["pigz"],
+    ".tar.bz2": ["lbzip2"],
+    ".tar.zst": ["zstd", "-q", "-T0", "-15"],
+    ".tar.xz": ["xz", "-T0", "-6"],
+}
+
+
+class streamTee:
+    # A write only file object writing everything to all of the streams.
+    def __init__(self, streams):
+        self.streams = streams
+
+    def write(self, data):
+        for stream in self.streams:
+            stream.write(data)
+        return len(data)
+
+
+def makeNodocsTars(sourceFile, destFiles):
+    # Write the tar archives destFiles, a dict of files by suffix, as the tar
+    # archive sourceFile without the entries matching nodocsPattern. The
+    # source is decompressed and filtered once, with no extraction, and the
+    # filtered stream is fed to all the compressors. The members that are
+    # kept are copied as they are.
+    start = time.time()
+    sourceSuffix = "".join(Path(sourceFile).suffixes[-2:])
+    decompress = subprocess.Popen(
+        [tarCompressors[sourceSuffix][0], "-dc", sourceFile], stdout=subprocess.PIPE
+    )
+    compressors = []
+    for suffix, destFile in destFiles.items():
+        print(f"Making nodocs {os.path.basename(destFile)}")
+        with open(destFile, "wb") as f:
+            compressors.append(
+                subprocess.Popen(
+                    tarCompressors[suffix], stdin=subprocess.PIPE, stdout=f
+                )
+            )
+    with tarfile.open(fileobj=decompress.stdout, mode="r|") as tarIn:
+        with tarfile.open(
+            fileobj=streamTee([compress.stdin for compress in compressors]),
+            mode="w|",
+            format=tarfile.GNU_FORMAT,
+        ) as tarOut:
+            for member in tarIn:
+                if nodocsPattern.match(member.name):
+                    continue
+                if member.isreg():
+                    tarOut.addfile(member, tarIn.extractfile(member))
+                else:
+                    tarOut.addfile(member)
+    for compress in compressors:
+        compress.stdin.close()
+    if decompress.wait() != 0 or any(compress.wait() != 0 for compress in compressors):
+        print("ERROR: making the nodocs tar archives failed")
+        exit(1)
+    print(
+        f"Made nodocs {', '.join(os.path.basename(f) for f in destFiles.values())}"
+        f" in {time.time() - start:.1f}s"
+    )
+
+
+def makeNodocsArchive(sourceFile, destFile, suffix):
+    # Write the zip or 7z destFile as sourceFile without the entries matching
+    # nodocsPattern, with no extraction. The kept entries aren't recompressed,
+    # the others are deleted from a copy of the archive.
+    print(f"Making nodocs {os.path.basename(destFile)}")
+    start = time.time()
+    if os.path.exists(destFile):
+        os.remove(destFile)
+    if suffix == ".zip":
+        with zipfile.ZipFile(sourceFile) as z:
+            names = z.namelist()
+        command = ["zip", "-q", "-d", "-nw", destFile, "-@"]
+    else:
+        result = subprocess.run(
+            ["7z", "l", "-slt", sourceFile],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        entries = result.stdout.split("----------\n", 1)[1]
+        names = [
+            line[len("Path = ") :]
+            for line in entries.splitlines()
+            if line.startswith("Path = ")
+        ]
+        command = ["7z", "d", "-bd", "-spd", destFile, f"@{destFile}.list"]
+    shutil.copyfile(sourceFile, destFile)
+    names = [name for name in names if nodocsPattern.match(name)]
+    if names:
+        with open(f"{destFile}.list", "w", encoding="utf-8") as f:
+            f.write("\n".join(names) + "\n")
+        with open(f"{destFile}.list") as f:
+            subprocess.run(command, stdin=f, check=True, stdout=subprocess.DEVNULL)
+        os.remove(f"{destFile}.list")
+    print(f"Made nodocs {os.path.basename(destFile)} in {time.time() - start:.1f}s")
+
+
+def extractTree(archiveName, rootName, treeDir):
+    # Extract the directory rootName of the tar archive archiveName as
+    # treeDir, the release tree that the website upload reads. This is done
+    # once per archive: treeDir.sha256 records the sha256 of the archive
+    # treeDir was extracted from.
+    sha256 = fileHash(archiveName)
+    if os.path.isdir(treeDir) and os.path.isfile(treeDir + ".sha256"):
+        with open(treeDir + ".sha256") as f:
+            if f.read().strip() == sha256:
+                print(f"{treeDir} is already extracted from {archiveName}")
+                return
+    if os.path.exists(treeDir + ".sha256"):
+        os.remove(treeDir + ".sha256")
+    extractDir = treeDir + ".tmp"
+    if os.path.isdir(extractDir):
+        shutil.rmtree(extractDir)
+    Path(extractDir).mkdir(parents=True)
+    subprocess.run(
+        ["tar", "-xf", os.path.abspath(archiveName), "-C", extractDir], check=True
+    )
+    if os.path.isdir(treeDir):
+        shutil.rmtree(treeDir)
+    os.rename(os.path.join(extractDir, rootName), treeDir)
+    shutil.rmtree(extractDir)
+    with open(treeDir + ".sha256", "w") as f:
+        f.write(sha256 + "\n")
+
+
+def pushSubmoduleTags(git_tag):
+    # Push git_tag to origin in every submodule of the current repository,
+    # tagPushJobs at a time, and wait for all of them. Failed pushes are
+    # retried, except rejected ones. Prints a result by submodule and returns
+    # whether they all succeeded.
+    result = subprocess.run(
+        ["git", "submodule", "foreach", "--quiet", "pwd"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    submoduleDirs = result.stdout.split()
+
+    def push(submoduleDir):
+        for attempt in range(1, tagPushRetries + 2):
+            result = subprocess.run(
+                ["git", "push", "--quiet", "origin", git_tag],
+                cwd=submoduleDir,
+                capture_output=True,
+                text=True,
+            )
+            if result.returncode == 0:
+                return (submoduleDir, True, attempt, "")
+            lines = result.stderr.strip().splitlines() or [""]
+            message = next(
+                (l for l in lines if l.startswith(("fatal:", "error:", " ! "))),
+                lines[-1],
+            ).strip()
+            if "rejected" in result.stderr or attempt > tagPushRetries:
+                return (submoduleDir, False, attempt, message)
+            time.sleep(5 * attempt)
+
+    with concurrent.futures.ThreadPoolExecutor(tagPushJobs) as pool:
+        results = list(pool.map(push, submoduleDirs))
+
+    width = max([len(os.path.basename(d)) for d in submoduleDirs] + [9])
+    print(f"{'submodule':<{width}}  result  attempts")
+    for submoduleDir, ok, attempts, message in results:
+        print(
+            f"{os.path.basename(submoduleDir):<{width}}  {'ok' if ok else 'FAILED':<6}  {attempts}  {message}"
+        )
+    failed = [r for r in results if not r[1]]
+    print(f"{len(results) - len(failed)} of {len(results)} submodule tags pushed.")
+    return not failed
+
+
 def git_tags():
     if options.rc != None or not git_tag:
         print("This is a release candidate. Not tagging.")
@@ -260,10 +778,7 @@ def git_tags():
     print(
         f"The git submodules have been tagged in {boost_repo_parent_dir}/boost. That should be fine, but you may review. The next step will be 'git push'."
     )
-    answer = input("Do you want to continue: [y/n]")
-    if not answer or answer[0].lower() != "y":
-        print("Exiting.")
-        exit(1)
+    askToContinue("Do you want to continue: [y/n]")
     print(f"git push origin {git_tag}")
     result = subprocess.run(f"git push origin {git_tag}", shell=True, text=True)
     if result.returncode != 0:
@@ -277,66 +792,57 @@ def git_tags():
     #     f"git submodule foreach 'git push origin {git_tag}'", shell=True, text=True
     # )
 
-    # Submodules in a parallel loop. Faster.
-    print(
-        f"Running the equivalent of the following in a bash loop: git submodule foreach 'git push origin {git_tag}'"
-    )
-    subcommand = "git push origin %s" % git_tag
-    result = subprocess.run(
-        "for DIR in $(git submodule foreach -q sh -c pwd); do cd $DIR && %s & done"
-        % subcommand,
-        text=True,
-        shell=True,
-    )
-    if result.returncode != 0:
+    # Submodules in parallel, on a bounded pool.
+    print(f"Pushing {git_tag} in every submodule, {tagPushJobs} at a time.")
+    if not pushSubmoduleTags(git_tag):
         print("git push submodules failed")
-        print(result)
         exit(1)
 
-    sleep_seconds = 30
-    print(f"Waiting {sleep_seconds} seconds for git submodules to upload.")
-    print("Adjusts the length of time in the script if needed.")
-    print("You may exit from the sleep loop with a Ctrl-C.")
-    sleep(sleep_seconds)
-
     # function complete
     os.chdir(origDir)
 
 
-def preflight():
-    load_dotenv()
+def askToContinue(question="Do you want to continue anyway: [y/n]"):
+    # Ask whether to go on, and exit if not. With --yes or --strict the
+    # answer is yes, so that nothing waits for a person. --strict only
+    # stops on preflight problems, see preflight.
+    if options.yes or options.strict:
+        print(f"{question} y (--{'yes' if options.yes else 'strict'})")
+        return
+    answer = input(question)
+    if not answer or answer[0].lower() != "y":
+        print("Exiting.")
+        exit(1)
 
-    result = subprocess.run("nproc", shell=True, text=True, capture_output=True)
-    if result.stdout:
-        cpus = int(result.stdout.strip())
-    else:
-        cpus = 0
-    if cpus > 0 and cpus < 3:
-        print(
-            f"The number of cpus detected was {cpus}. It is recommended\
- to resize this machine."
-        )
-        print(
-            "admin-server.boost.cpp.al may be resized by going to the release-tools\
- GitHub Actions page and manually triggering 'Resize Deployment Server'."
-        )
-        answer = input("Do you want to continue: [y/n]")
-        if not answer or answer[0].lower() != "y":
-            print("Exiting.")
-            exit(1)
 
-    print(
-        "Testing /etc/mime.types. The file should exist and contain hpp, but please ensure it's a full copy from Linux."
-    )
+# The preflight checks. Each returns a list of problems, empty when the
+# check passed, and gives up after preflightTimeout seconds.
 
-    with open("/etc/mime.types") as myfile:
-        if "hpp" in myfile.read():
-            print("/etc/mime.types ok")
-        else:
-            print("/etc/mime.types check failed")
-            exit(1)
 
-    print("Searching for required executables.")
+def checkCpus():
+    cpus = len(os.sched_getaffinity(0))
+    if cpus > 0 and cpus < 3:
+        return [
+            f"The number of cpus detected was {cpus}. It is recommended to resize this machine. admin-server.boost.cpp.al may be resized by going to the release-tools GitHub Actions page and manually triggering 'Resize Deployment Server'."
+        ]
+    return []
+
+
+def checkMimeTypes():
+    # The file should exist and contain hpp, but please ensure it's a full
+    # copy from Linux.
+    try:
+        with open("/etc/mime.types") as myfile:
+            if "hpp" in myfile.read():
+                return []
+    except OSError as e:
+        return [f"/etc/mime.types could not be read: {e}"]
+    return [
+        "/etc/mime.types does not contain hpp. It should be a full copy from Linux."
+    ]
+
+
+def checkExecutables():
     required_executables = [
         "rclone",
         "curl",
@@ -350,118 +856,189 @@ def preflight():
         "lbzip2",
         "time",
     ]
-    for required_executable in required_executables:
-        if not shutil.which(required_executable):
-            print(f"{required_executable} is not installed. It may be needed later.")
-            answer = input("Do you want to continue anyway: [y/n]")
-            if not answer or answer[0].lower() != "y":
-                print("Exiting.")
-                exit(1)
+    for s in options.extra_formats.split(","):
+        if s.strip() == ".tar.zst":
+            required_executables.append("zstd")
+        elif s.strip() == ".tar.xz":
+            required_executables.append("xz")
+    return [
+        f"{required_executable} is not installed. It may be needed later."
+        for required_executable in required_executables
+        if not shutil.which(required_executable)
+    ]
 
-    print("Test ssh to brorigin servers")
 
+def checkOrigin(origin):
+    # BatchMode, so that a missing key fails instead of asking for a password.
     SSH_USER = os.getenv("SSH_USER", "mclow")
-    for origin in ["brorigin1.cpp.al", "brorigin2.cpp.al"]:
-        result = subprocess.run(
-            f'ssh {SSH_USER}@{origin} "echo test > test10.txt"',
-            shell=True,
-            capture_output=True,
-            text=True,
-        )
-        if result.returncode != 0:
-            print("SSH FAILED")
-            print(
-                "Preflight verification of SSH to the CDN origin servers failed. Check your SSH keys, and set SSH_USER=_username_ in an .env file in the same directory as publish_release.py. The best way to debug is manually SSHing to brorigin1.cpp.al and brorigin2.cpp.al"
-            )
-            print(result)
-            answer = input("Do you want to continue anyway: [y/n]")
-            if not answer or answer[0].lower() != "y":
-                print("Exiting.")
-                exit(1)
+    result = subprocess.run(
+        f'ssh -o BatchMode=yes -o ConnectTimeout={preflightTimeout} {SSH_USER}@{origin} "echo test > test10.txt"',
+        shell=True,
+        capture_output=True,
+        text=True,
+        timeout=preflightTimeout,
+    )
+    if result.returncode != 0:
+        return [
+            f"SSH to {origin} failed: {result.stderr.strip()}",
+            "Check your SSH keys, and set SSH_USER=_username_ in an .env file in the same directory as publish_release.py. The best way to debug is manually SSHing to brorigin1.cpp.al and brorigin2.cpp.al",
+        ]
+    return []
 
-    # github verification:
-    print("Test github connection")
 
+def checkGithub():
     result = subprocess.run(
-        f"ssh -T git@github.com",
+        f"ssh -o BatchMode=yes -o ConnectTimeout={preflightTimeout} -T git@github.com",
         shell=True,
         capture_output=True,
         text=True,
+        timeout=preflightTimeout,
     )
     if not "successfully authenticated" in result.stderr:
-        print("GITHUB TEST FAILED")
-        print(
-            "Preflight test of your connection to github failed. This command was run: 'ssh -T git@github.com' You should configure ~/.ssh/config with:\nHost github.com\n    User git\n    Hostname github.com\n    PreferredAuthentications publickey\n    IdentityFile /home/__path__to__file__"
-        )
-        print(result)
-        answer = input("Do you want to continue anyway: [y/n]")
-        if not answer or answer[0].lower() != "y":
-            print("Exiting.")
-            exit(1)
+        return [
+            f"'ssh -T git@github.com' failed: {result.stderr.strip()}",
+            "You should configure ~/.ssh/config with:\nHost github.com\n    User git\n    Hostname github.com\n    PreferredAuthentications publickey\n    IdentityFile /home/__path__to__file__",
+        ]
+    return []
+
+
+def checkWebsite(boost_website):
+    WEB_USER = os.getenv("WEB_USER", "marshall@idio.com")
+    WEB_PASSWORD = os.getenv("WEB_PASSWORD", "qqq")
+    WEBSITE_URL = boost_website
+    BASE_ADMIN = f"{WEBSITE_URL}/admin/"
+    LOGIN = f"{BASE_ADMIN}login/"
+
+    session = requests.session()
+    # do a request just to get a csrftoken
+    response = session.get(LOGIN, timeout=preflightTimeout)
+    response.raise_for_status()
+    if "csrftoken" not in session.cookies:
+        return [f"{LOGIN} did not set a csrftoken."]
+    response = session.post(
+        LOGIN,
+        data={
+            "csrfmiddlewaretoken": session.cookies["csrftoken"],
+            "username": WEB_USER,
+            "password": WEB_PASSWORD,
+        },
+        timeout=preflightTimeout,
+    )
+    response.raise_for_status()
+    if "errornote" in response.text:
+        return [
+            f"An 'errornote' was found in the attempt to log into {boost_website} with your WEB_USER and WEB_PASSWORD. Review those values in the .env file, and try manually logging into the admin panel"
+        ]
+    return []
 
-    # webhook verification:
-    for boost_website in boost_websites:
-        print(f"Checking admin login to {boost_website}")
-        WEB_USER = os.getenv("WEB_USER", "marshall@idio.com")
-        WEB_PASSWORD = os.getenv("WEB_PASSWORD", "qqq")
-        WEBSITE_URL = boost_website
-        BASE_ADMIN = f"{WEBSITE_URL}/admin/"
-        LOGIN = f"{BASE_ADMIN}login/"
 
-        session = requests.session()
-        # do a request just to get a csrftoken
-        response = session.get(LOGIN)
-        response.raise_for_status()
-        response = session.post(
-            LOGIN,
-            data={
-                "csrfmiddlewaretoken": session.cookies["csrftoken"],
-                "username": WEB_USER,
-                "password": WEB_PASSWORD,
-            },
-        )
-        response.raise_for_status()
-        if "errornote" in response.text:
+def preflight():
+    load_dotenv()
+
+    # (name, check, arguments, fatal). The checks are independent, so they
+    # all run at the same time, and the problems are reported together.
+    checks = [
+        ("cpus", checkCpus, [], False),
+        ("/etc/mime.types", checkMimeTypes, [], True),
+        ("executables", checkExecutables, [], False),
+        ("ssh brorigin1.cpp.al", checkOrigin, ["brorigin1.cpp.al"], False),
+        ("ssh brorigin2.cpp.al", checkOrigin, ["brorigin2.cpp.al"], False),
+        ("ssh github.com", checkGithub, [], False),
+    ] + [
+        (f"login {boost_website}", checkWebsite, [boost_website], False)
+        for boost_website in boost_websites
+    ]
+
+    print("Running the preflight checks.")
+    with concurrent.futures.ThreadPoolExecutor(len(checks)) as pool:
+        futures = [pool.submit(check, *arguments) for _, check, arguments, _ in checks]
+    failures = []
+    for (name, _, _, fatal), future in zip(checks, futures):
+        try:
+            problems = future.result()
+        except subprocess.TimeoutExpired:
+            problems = [f"No answer after {preflightTimeout} seconds."]
+        except Exception as e:
+            problems = [f"{type(e).__name__}: {e}"]
+        print(f"{name:<36}{'FAILED' if problems else 'ok'}")
+        if problems:
+            failures.append((name, fatal, problems))
+
+    if not failures:
+        return
+    print("\nPreflight problems:")
+    for name, fatal, problems in failures:
+        print(f"\n{name}{' (fatal)' if fatal else ''}:")
+        for problem in problems:
+            print(f"    {problem}")
+    print()
+    if any(fatal for _, fatal, _ in failures):
+        print("Exiting.")
+        exit(1)
+    if options.strict:
+        print("Exiting (--strict).")
+        exit(1)
+    askToContinue()
+
+
+def waitForCDN(urls, deadline):
+    # Check all the urls at the same time, again and again with a growing
+    # delay, until they are all on the CDN or deadline seconds have passed.
+    # Returns the urls that are still missing.
+    async def present(url, limit):
+        async with limit:
+            try:
+                r = await asyncio.to_thread(
+                    downloadSession.head, url, allow_redirects=True, timeout=30
+                )
+                return r.status_code == 200
+            except requests.exceptions.RequestException:
+                return False
+
+    async def poll():
+        # As many at a time as the session keeps connections.
+        limit = asyncio.Semaphore(downloadJobs)
+        missing = list(urls)
+        end = time.monotonic() + deadline
+        delay = 5
+        while True:
+            found = await asyncio.gather(*(present(url, limit) for url in missing))
+            missing = [url for url, ok in zip(missing, found) if not ok]
+            left = end - time.monotonic()
+            if not missing or left <= 0:
+                return missing
             print(
-                f"An 'errornote' was found in the attempt to log into {boost_website} with your WEB_USER and WEB_PASSWORD. Review those values in the .env file, and try manually logging into the admin panel"
+                f"{len(missing)} of {len(urls)} files are not on the CDN yet. Checking again in {min(delay, left):.0f} seconds."
             )
-            answer = input("Do you want to continue anyway: [y/n]")
-            if not answer or answer[0].lower() != "y":
-                print("Exiting.")
-                exit(1)
+            await asyncio.sleep(min(delay, left))
+            delay = min(delay * 2, 60)
+
+    return asyncio.run(poll())
 
 
 def import_new_releases():
     print(
         "\nThe last step is to trigger a version import on boost.io. This can also be done by visiting https://www.boost.io/admin/versions/version/ and clicking 'Import New Releases' for betas, or 'Do It All' for a full release. publish_release.py will remotely contact that webpage with a GET request.\n"
     )
-    print("Waiting 2 minutes for the CDN to update, before proceeding.\n")
-    time.sleep(120)
-
-    for s in suffixes:
-        for appended in ["", ".json"]:
-            archiveFilename = actualName + s + appended
-            archivePathRemote = re.sub("^main/", "", destRepo)
-            url = f"{fastlyURL}{archivePathRemote}{archiveFilename}"
-
-            result = subprocess.run(
-                f"curl --output /dev/null --silent --head --fail {url}",
-                capture_output=True,
-                shell=True,
-                text=True,
-            )
-
-            if result.returncode != 0:
-                print(
-                    f"\n{archiveFilename} is not present on the CDN, when it was expected. Check all the release files are available for download, and then manually log into the website to import releases. Exiting.\n"
-                )
-                print(result)
-                exit(1)
-            else:
-                print(
-                    "Expected archive file is present. See debug output below. continuing."
-                )
-                print(result)
+    print(
+        f"Waiting up to {options.cdn_deadline} seconds for the CDN to update, before proceeding.\n"
+    )
+    archivePathRemote = re.sub("^main/", "", destRepo)
+    urls = [
+        f"{fastlyURL}{archivePathRemote}{actualName}{s}{appended}"
+        for s in suffixes
+        for appended in ["", ".json"]
+    ]
+    missing = waitForCDN(urls, options.cdn_deadline)
+    if missing:
+        print("\nThese files are not present on the CDN, when they were expected:")
+        for url in missing:
+            print(f"    {url}")
+        print(
+            "\nCheck all the release files are available for download, and then manually log into the website to import releases. Exiting.\n"
+        )
+        exit(1)
+    print("All the expected archive files are present on the CDN. Continuing.")
 
     for boost_website in boost_websites:
         WEB_USER = os.getenv("WEB_USER", "marshall@idio.com")
@@ -502,6 +1079,89 @@ def import_new_releases():
     # End of function import_new_releases
 
 
+# The stages of a release, in order. A rerun skips the stages that
+# completed in an earlier run, as recorded in the journal, when their
+# outputs are still there and unchanged.
+stageNames = [
+    "tag",
+    "download",
+    "json",
+    "extract",
+    "nodocs",
+    "jfrog",
+    "website",
+    "archives",
+    "staging",
+    "cdn",
+    "import",
+]
+
+
+def loadJournal():
+    global journal
+    journal = {}
+    if options.restart or not os.path.isfile(journalFile):
+        return
+    with open(journalFile) as f:
+        journal = json.load(f)
+    print(f"Resuming from the journal {journalFile}")
+
+
+def saveJournal():
+    with open(journalFile + ".tmp", "w") as f:
+        json.dump(journal, f, indent=1)
+    os.replace(journalFile + ".tmp", journalFile)
+
+
+def outputHashes(outputs):
+    # The sha256 of the output files, and "" for the output directories.
+    return dict(
+        (os.path.abspath(o), fileHash(o) if os.path.isfile(o) else "") for o in outputs
+    )
+
+
+def stageVerified(name, outputs):
+    # Whether the stage completed in an earlier run, and made the same
+    # outputs as this run would, which are still there and unchanged.
+    entry = journal.get(name)
+    if entry is None:
+        return False
+    recorded = entry["outputs"]
+    if sorted(recorded) != sorted(os.path.abspath(o) for o in outputs):
+        return False
+    for output, sha256 in recorded.items():
+        if sha256 == "":
+            if not os.path.isdir(output):
+                return False
+        elif not os.path.isfile(output) or fileHash(output) != sha256:
+            return False
+    return True
+
+
+def runStage(name, stage, outputs=[]):
+    # Run stage() as the stage name, making the files or directories
+    # outputs, unless it is verified done. Returns the value stage()
+    # returned, now or in the earlier run.
+    redo = [s.strip() for s in options.redo.split(",")]
+    if name not in redo and stageVerified(name, outputs):
+        print(f"Stage {name} was completed in an earlier run. Skipping.")
+        return journal[name].get("value")
+    print(f"Stage {name}")
+    value = stage()
+    hashes = outputHashes(outputs)
+    if name in journal and journal[name]["outputs"] != hashes:
+        # The outputs changed, so the later stages are done again.
+        for later in stageNames[stageNames.index(name) + 1 :]:
+            journal.pop(later, None)
+    journal[name] = {
+        "outputs": hashes,
+        "value": value,
+        "completed": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    }
+    saveJournal()
+    return value
+
+
 #####
 usage = "usage: %prog [options] boost_version     # Example: %prog 1_85_0"
 parser = OptionParser(usage=usage)
@@ -568,6 +1228,21 @@ parser.add_option(
     dest="skip_nodocs",
 )
 
+parser.add_option(
+    "--cdn-deadline",
+    default=600,
+    type="int",
+    help="seconds to wait for the release files to be on the CDN (default 600)",
+    dest="cdn_deadline",
+)
+
+parser.add_option(
+    "--extra-formats",
+    default="",
+    help="comma separated archive formats published in addition to the standard ones, i.e. '.tar.zst,.tar.xz'",
+    dest="extra_formats",
+)
+
 parser.add_option(
     "--skip-redownloading",
     default=False,
@@ -595,11 +1270,51 @@ parser.add_option(
     dest="dryrun_staging",
 )
 
+parser.add_option(
+    "-y",
+    "--yes",
+    default=False,
+    action="store_true",
+    help="answer yes to every question, and continue past preflight warnings",
+    dest="yes",
+)
+
+parser.add_option(
+    "--strict",
+    default=False,
+    action="store_true",
+    help="exit on any preflight problem, and answer yes to every other question",
+    dest="strict",
+)
+
+parser.add_option(
+    "--restart",
+    default=False,
+    action="store_true",
+    help="ignore the journal of an earlier run, and run every stage",
+    dest="restart",
+)
+
+parser.add_option(
+    "--redo",
+    default="",
+    help="comma separated stages to run again even if they were completed, of: "
+    + ", ".join(stageNames),
+    dest="redo",
+)
+
 (options, args) = parser.parse_args()
 if len(args) != 1:
     print("Too Many arguments")
     parser.print_help()
     exit(1)
+if options.yes and options.strict:
+    print("--yes and --strict can't be used together")
+    exit(1)
+for s in options.redo.split(","):
+    if s.strip() and s.strip() not in stageNames:
+        print(f"Unknown stage {s.strip()}")
+        exit(1)
 
 preflight()
 
@@ -634,130 +1349,128 @@ if options.rc != None:
     # or, does an rc get tagged?
     git_tag = ""
 
-if options.git_tagging:
-    git_tags()
-else:
-    print(
-        "You did not run this script with the --git-tag option. Please be sure you have already tagged the release. In the future publish-release.py should switch --git-tag to --skip-git-tag and enable tagging by default."
-    )
-    answer = input("Do you want to continue anyway: [y/n]")
-    if not answer or answer[0].lower() != "y":
-        print("Exiting.")
-        exit(1)
-
 if options.progress:
     print("Creating release files named '%s'" % actualName)
     if options.dryrun:
         print("## Dry run; not uploading files to s3://boost-archives/")
 
 suffixes = [".7z", ".zip", ".tar.bz2", ".tar.gz"]
+for s in options.extra_formats.split(","):
+    s = s.strip()
+    if not s:
+        continue
+    if s not in [".tar.zst", ".tar.xz"]:
+        print(f"Unknown archive format {s}")
+        exit(1)
+    if s not in suffixes:
+        suffixes.append(s)
 snapshotName = "boost_%s-snapshot" % boostVersion
+archiveDir = str(Path.home()) + "/archives"
+nodocsDir = str(Path.home()) + "/archives-nodocs"
+origDir = os.getcwd()
+
+journalFile = os.path.abspath(actualName + ".journal.json")
+loadJournal()
+
+if options.git_tagging:
+    runStage("tag", git_tags)
+else:
+    print(
+        "You did not run this script with the --git-tag option. Please be sure you have already tagged the release. In the future publish-release.py should switch --git-tag to --skip-git-tag and enable tagging by default."
+    )
+    askToContinue()
+
 
 # Download the files
-if options.progress:
-    print("Downloading from: %s" % sourceRepo)
-for s in suffixes:
-    # downloadJFROGFiles(sourceRepo, snapshotName, actualName, s)
-    downloadFASTLYFiles(snapshotName, actualName, s)
+def downloadStage():
+    if options.progress:
+        print("Downloading from: %s" % sourceRepo)
+    for s in suffixes:
+        # downloadJFROGFiles(sourceRepo, snapshotName, actualName, s)
+        downloadFASTLYFiles(snapshotName, actualName, s)
+
+
+runStage(
+    "download",
+    downloadStage,
+    [actualName + s for s in suffixes] + [snapshotName + s + ".json" for s in suffixes],
+)
+
 
 # Create the JSON files
-for s in suffixes:
-    sourceFileName = actualName + s
-    jsonFileName = sourceFileName + ".json"
-    jsonSnapshotName = snapshotName + s + ".json"
-    if options.progress:
-        print("Writing JSON to: %s" % jsonFileName)
-    jsonData = genJSON(jsonSnapshotName, sourceFileName, fileHash(sourceFileName))
-    with open(jsonFileName, "w", encoding="utf-8") as f:
-        json.dump(jsonData, f, ensure_ascii=False, indent=0)
+def jsonStage():
+    for s in suffixes:
+        sourceFileName = actualName + s
+        jsonFileName = sourceFileName + ".json"
+        jsonSnapshotName = snapshotName + s + ".json"
+        if options.progress:
+            print("Writing JSON to: %s" % jsonFileName)
+        jsonData = genJSON(jsonSnapshotName, sourceFileName, fileHash(sourceFileName))
+        with open(jsonFileName, "w", encoding="utf-8") as f:
+            json.dump(jsonData, f, ensure_ascii=False, indent=0)
 
-if not checksum_succeeded:
-    exit(1)
+    if not checksum_succeeded:
+        exit(1)
+
+
+runStage("json", jsonStage, [actualName + s + ".json" for s in suffixes])
+
+
+def extractStage():
+    print("Extracting one archive locally in ~/archives/")
+    print("This is used for the web upload later.")
+    Path(archiveDir).mkdir(parents=True, exist_ok=True)
+    extractTree(
+        actualName + ".tar.gz",
+        unzippedArchiveName,
+        os.path.join(archiveDir, hostedArchiveName),
+    )
+
+
+runStage(
+    "extract",
+    extractStage,
+    [
+        os.path.join(archiveDir, hostedArchiveName),
+        os.path.join(archiveDir, hostedArchiveName) + ".sha256",
+    ],
+)
 
-print("Extracting one archive locally in ~/archives/")
-print("This is used for the web upload later.")
-archiveDir = str(Path.home()) + "/archives"
-archiveDirTmp = str(Path.home()) + "/archives/tmp"
-archiveName = actualName + ".tar.gz"
-Path(archiveDir).mkdir(parents=True, exist_ok=True)
-if os.path.isdir(archiveDirTmp):
-    shutil.rmtree(archiveDirTmp)
-Path(archiveDirTmp).mkdir(parents=True, exist_ok=True)
-shutil.copyfile(archiveName, archiveDirTmp + "/" + archiveName)
-origDir = os.getcwd()
-os.chdir(archiveDirTmp)
-os.system("tar -xf %s" % (archiveName))
-os.chdir(archiveDir)
-if os.path.isdir(hostedArchiveName):
-    shutil.rmtree(hostedArchiveName)
-shutil.move(archiveDirTmp + "/" + unzippedArchiveName, hostedArchiveName)
-os.chdir(origDir)
 
 # Generate nodocs versions
-if not options.skip_nodocs:
+def nodocsStage():
     print("Processing nodocs")
-    origDir = os.getcwd()
-    # [".7z", ".zip", ".tar.bz2", ".tar.gz"]
-    unzip_method = {}
-    unzip_method[".7z"] = "7z x"
-    unzip_method[".zip"] = "unzip -q"
-    unzip_method[".tar.bz2"] = "tar -xf"
-    unzip_method[".tar.gz"] = "tar -xf"
-    zip_method = {}
-    zip_method[".7z"] = "7z a -bd -mx=7 -mmt8 -ms=on"
-    zip_method[".zip"] = "zip -qr -9"
-    # zip_method[".tar.bz2"] = "tar -jcf"
-    zip_method[".tar.bz2"] = "tar -cf"
-    # zip_method[".tar.gz"] = "tar -zcf"
-    zip_method[".tar.gz"] = "tar -cf"
-    zip_extra_flags = {}
-    zip_extra_flags[".7z"] = ""
-    zip_extra_flags[".zip"] = ""
-    zip_extra_flags[".tar.bz2"] = "--use-compress-program=lbzip2"
-    zip_extra_flags[".tar.gz"] = "--use-compress-program=pigz"
+    Path(nodocsDir).mkdir(parents=True, exist_ok=True)
+    # The tar archives all hold the same LF tree, they are all made from
+    # the .tar.gz. The zip and 7z archives are made from themselves.
+    with concurrent.futures.ThreadPoolExecutor(len(suffixes)) as pool:
+        nodocs = [
+            pool.submit(
+                makeNodocsTars,
+                os.path.join(origDir, actualName + ".tar.gz"),
+                dict(
+                    (s, os.path.join(nodocsDir, actualName + s))
+                    for s in suffixes
+                    if s in tarCompressors
+                ),
+            )
+        ]
+        for s in suffixes:
+            if s not in tarCompressors:
+                nodocs.append(
+                    pool.submit(
+                        makeNodocsArchive,
+                        os.path.join(origDir, actualName + s),
+                        os.path.join(nodocsDir, actualName + s),
+                        s,
+                    )
+                )
+        for future in nodocs:
+            future.result()
 
     for s in suffixes:
-        os.chdir(origDir)
-        archiveName = actualName + s
-        archiveDirTmp = str(Path.home()) + f"/archives-nodocs/{s}"
-        if os.path.isdir(archiveDirTmp):
-            shutil.rmtree(archiveDirTmp)
-        Path(archiveDirTmp).mkdir(parents=True, exist_ok=True)
-        shutil.copyfile(archiveName, archiveDirTmp + "/" + archiveName)
-        os.chdir(archiveDirTmp)
-        extraction_command = unzip_method[s]
-        print(f"Extracting {archiveName}")
-        # os.system(f"{extraction_command} {archiveName}")
-        result = subprocess.run(
-            f"time -p {extraction_command} {archiveName}",
-            shell=True,
-            capture_output=True,
-            text=True,
-        )
-        print(result.stdout)
-        print(result.stderr)
-        os.chdir(f"boost_{boostVersion}")
-        print(f"Removing doc/ directories")
-        os.system("rm -rf libs/*/doc libs/numeric/*/doc tools/*/doc doc/")
-        os.chdir("../")
-        if os.path.exists("../" + archiveName):
-            print(f"Removing {archiveName}")
-            os.remove("../" + archiveName)
-        compression_method = zip_method[s]
-        extra_flags = zip_extra_flags[s]
-        print(f"Compressing {archiveName}")
-        # os.system(f"{compression_method} ../{archiveName} boost_{boostVersion}")
-        result = subprocess.run(
-            f"time -p {compression_method} ../{archiveName} boost_{boostVersion} {extra_flags}",
-            shell=True,
-            capture_output=True,
-            text=True,
-        )
-        print(result.stdout)
-        print(result.stderr)
-        os.chdir("../")
-
         # Create the JSON files
+        os.chdir(nodocsDir)
         sourceFileName = actualName + s
         jsonFileName = sourceFileName + ".json"
         jsonSnapshotName = origDir + "/" + snapshotName + s + ".json"
@@ -772,14 +1485,27 @@ if not options.skip_nodocs:
         os.chdir(origDir)
 
 
+if not options.skip_nodocs:
+    runStage(
+        "nodocs",
+        nodocsStage,
+        [os.path.join(nodocsDir, actualName + s) for s in suffixes]
+        + [os.path.join(nodocsDir, actualName + s + ".json") for s in suffixes],
+    )
+
+
 # Upload the files to JFROG
-if options.progress:
-    print("Uploading to: %s" % destRepo)
-if not options.dryrun_jfrog and not options.dryrun:
+def jfrogStage():
     for s in suffixes:
         copyJFROGFile(sourceRepo, snapshotName, destRepo, actualName, s)
         uploadJFROGFile(actualName + s + ".json", destRepo)
 
+
+if options.progress:
+    print("Uploading to: %s" % destRepo)
+if not options.dryrun_jfrog and not options.dryrun:
+    runStage("jfrog", jfrogStage)
+
 ##############################################################
 #
 # Upload extracted files to S3 for the website docs
@@ -807,6 +1533,22 @@ os.makedirs(str(Path.home()) + "/.config/rclone", exist_ok=True)
 with open(str(Path.home()) + "/.config/rclone/rclone.conf", "w") as f:
     f.writelines(rclonefilecontents)
 
+
+def websiteStage():
+    # AWS cli method:
+    # archivePathRemote="s3://" + bucket + "/archives/" + hostedArchiveName + "/"
+    # os.system("aws s3 cp --recursive --region %s --profile %s %s %s" % (aws_region, profile, archivePathLocal, archivePathRemote))
+
+    # Rclone method, to all the buckets at the same time:
+    remotes = [
+        (profile, "remote1:" + bucket + "/archives/" + hostedArchiveName + "/")
+        for profile, bucket in aws_profiles.items()
+    ]
+    if not syncWebsiteBuckets(archivePathLocal, remotes):
+        print("The website upload failed.")
+        exit(1)
+
+
 archivePathLocal = str(Path.home()) + "/archives/" + hostedArchiveName + "/"
 if not shutil.which("rclone"):
     print("rclone is not installed. Instructions:")
@@ -817,38 +1559,36 @@ elif not Path(str(Path.home()) + "/.aws/credentials").is_file():
     print("AWS credentials are missing. Please add the file ~/.aws/credentials .")
 else:
     if not options.dryrun and options.rc == None:
-        for profile, bucket in aws_profiles.items():
-            # AWS cli method:
-            # archivePathRemote="s3://" + bucket + "/archives/" + hostedArchiveName + "/"
-            # os.system("aws s3 cp --recursive --region %s --profile %s %s %s" % (aws_region, profile, archivePathLocal, archivePathRemote))
-
-            # Rclone method:
-            archivePathRemote = (
-                "remote1:" + bucket + "/archives/" + hostedArchiveName + "/"
-            )
-            os.system(
-                "export AWS_PROFILE=%s;rclone sync --transfers 16 --checksum %s %s"
-                % (profile, archivePathLocal, archivePathRemote)
-            )
+        runStage("website", websiteStage)
+
 
 # Upload archives to S3
-if not options.dryrun:
-    for s in suffixes:
-        uploadS3File(actualName + s, destRepo)
-        uploadS3File(actualName + s + ".json", destRepo)
+def archivesStage():
+    uploadS3Files(
+        [actualName + s for s in suffixes]
+        + [actualName + s + ".json" for s in suffixes],
+        destRepo,
+    )
     if not options.skip_nodocs:
-        for s in suffixes:
-            uploadS3File(
-                str(Path.home()) + "/archives-nodocs/" + actualName + s, destRepoNoDocs
-            )
-            uploadS3File(
-                str(Path.home()) + "/archives-nodocs/" + actualName + s + ".json",
-                destRepoNoDocs,
-            )
+        uploadS3Files(
+            [os.path.join(nodocsDir, actualName + s) for s in suffixes]
+            + [os.path.join(nodocsDir, actualName + s + ".json") for s in suffixes],
+            destRepoNoDocs,
+        )
+
+
+if not options.dryrun:
+    runStage("archives", archivesStage)
+
 
 # Publish Windows .exe files from their location in staging/
-if options.force_staging or (not options.dryrun and not options.dryrun_staging):
+def stagingStage():
     copyStagingS3()
+    return stagingPath2
+
+
+if options.force_staging or (not options.dryrun and not options.dryrun_staging):
+    stagingPath2 = runStage("staging", stagingStage)
 
 ###############################################################################
 #
@@ -860,7 +1600,8 @@ if options.force_staging or (not options.dryrun and not options.dryrun_staging):
 # To refresh them more quickly, upload a text file with information.
 #
 
-if not options.dryrun:
+
+def cdnStage():
     load_dotenv()
     SSH_USER = os.getenv("SSH_USER", "mclow")
 
@@ -914,5 +1655,9 @@ if not options.dryrun:
             print("SSH FAILED")
             print(result)
 
+
+if not options.dryrun:
+    runStage("cdn", cdnStage)
+
 if not options.dryrun:
-    import_new_releases()
+    runStage("import", import_new_releases)
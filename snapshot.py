@@ -117,7 +117,7 @@ def expand_7z (dest, source):
 def fixDirPerms (dir):
 	os.system ( "find %s -type d -exec chmod 755 {} \;" % dir )
 	
-def do_it(svnUrl, tag, suffix, releaseRevision, server, username, password, doUpload, doDocs):
+def do_it(svnUrl, tag, suffix, releaseRevision, server, username, password, doUpload, doDocs, ignore=None):
 	windowsDir  = "windows"
 	posixDir    = "posix"
 	boostName   = "boost_" + tag
@@ -140,7 +140,7 @@ def do_it(svnUrl, tag, suffix, releaseRevision, server, username, password, doUp
 #	fixDirPerms ( posixName )
 	# Merge in the docs
 	if doDocs:
-		mergetree ( kDocsTemp, posixName )
+		mergetree ( kDocsTemp, posixName, ignore=ignore )
 		
 	# Make Windows folder export with CRLF line endings
 	os.mkdir ( windowsDir )
@@ -148,7 +148,7 @@ def do_it(svnUrl, tag, suffix, releaseRevision, server, username, password, doUp
 #	fixDirPerms ( windowsName )
 	# Merge in the docs
 	if doDocs:
-		mergetree ( kDocsTemp, windowsName )
+		mergetree ( kDocsTemp, windowsName, ignore=ignore )
 
 	# Create tar.gz and tar.bz2 files
 	outputName = "boost_" + tag
@@ -208,8 +208,14 @@ parser.add_argument('--server', dest='server', default="results.boost.org", acti
 					help='ftp server to download docs from and upload snapshots to')
 parser.add_argument('--user', dest='username', default="", action="store")
 parser.add_argument('--pass', dest='password', default="", action="store")
+parser.add_argument('-ignore-file', dest='ignoreFile', default=None,
+					help='leave out of the merged docs what MakeBoostDistro leaves out, plus the patterns in this file')
 parser.add_argument('tag', help='the tag to label the snapshot with')
 
 results = parser.parse_args()
+ignore = None
+if results.ignoreFile:
+	from MakeBoostDistro import IgnoreFiles, ReadIgnoreFile
+	ignore = IgnoreFiles.extend(ReadIgnoreFile(results.ignoreFile))
 do_it(results.svnURL, results.tag, results.suffix, results.revision, results.server, results.username, \
-	results.password, not results.noupload, not results.nodocs)
+	results.password, not results.noupload, not results.nodocs, ignore)